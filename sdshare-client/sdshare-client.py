@@ -0,0 +1,278 @@
+"""
+A simple SDshare client which polls the fragments feeds of one or more
+collections, fetches the fragments in parallel, and passes them on to
+sdshare-writer as N-Triples. The position reached in each feed is
+saved, so that a restarted client picks up where it left off.
+"""
+
+import sys, os, time, httplib, socket, urlparse, urllib, threading
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+from xml.etree import cElementTree as ElementTree
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+RDF = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+FRAGMENT_REL = "http://www.sdshare.org/2012/core/fragment"
+
+WORKERS = 8
+POLL_INTERVAL = 10 # seconds
+CHECKPOINT_FILE = "checkpoints.txt"
+
+class SDshareError(Exception):
+    pass
+
+class Unavailable(SDshareError):
+    "A 503 response. retry_after is the number of seconds to wait."
+
+    def __init__(self, message, retry_after):
+        SDshareError.__init__(self, message)
+        self.retry_after = retry_after
+
+# --- HTTP
+
+class ConnectionCache(threading.local):
+    """Keeps a keep-alive connection to each server for each thread, so
+    that the worker threads don't have to reconnect for every fragment."""
+
+    def __init__(self):
+        self._conns = {}
+
+    def request(self, method, url, body = None, headers = {}):
+        "Returns (response body, content type)."
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path
+        if parts.query:
+            path += "?" + parts.query
+
+        for attempt in (1, 2):
+            conn = self._conns.get(key)
+            if not conn:
+                if parts.scheme == "https":
+                    conn = httplib.HTTPSConnection(parts.netloc)
+                else:
+                    conn = httplib.HTTPConnection(parts.netloc)
+                self._conns[key] = conn
+
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                # the server may have closed an idle connection, so we
+                # try once more on a fresh one
+                conn.close()
+                del self._conns[key]
+                if attempt == 2:
+                    raise
+
+        message = "%s %s gave %s %s" % (method, url, response.status,
+                                        response.reason)
+        if response.status == 503:
+            raise Unavailable(message, parse_retry_after(
+                response.getheader("retry-after")))
+        if response.status < 200 or response.status >= 300:
+            raise SDshareError(message)
+        return (data, response.getheader("content-type", ""))
+
+def parse_retry_after(value):
+    "Returns the seconds in a Retry-After header, or POLL_INTERVAL."
+    try:
+        return max(int(value), 1)
+    except (TypeError, ValueError):
+        return POLL_INTERVAL # missing, or an HTTP date
+
+http = ConnectionCache()
+
+# --- FEED READING
+
+def read_page(url):
+    """Reads a page of a fragments feed, returning a list of (id,
+    updated, fragment url) entries and the url of the next page, or
+    None if this is the last one."""
+    feed = ElementTree.fromstring(http.request("GET", url)[0])
+
+    entries = []
+    for entry in feed.findall(ATOM + "entry"):
+        for link in entry.findall(ATOM + "link"):
+            if link.get("rel") == FRAGMENT_REL:
+                entries.append((entry.findtext(ATOM + "id"),
+                                entry.findtext(ATOM + "updated"),
+                                urlparse.urljoin(url, link.get("href"))))
+
+    next = None
+    for link in feed.findall(ATOM + "link"):
+        if link.get("rel") == "next":
+            next = urlparse.urljoin(url, link.get("href"))
+    return (entries, next)
+
+NTRIPLES_ACCEPT = "application/n-triples, application/rdf+xml;q=0.5"
+
+def fetch_fragment(url):
+    """Fetches a fragment as N-Triples, converting from RDF/XML if the
+    server doesn't support N-Triples."""
+    (data, type) = http.request("GET", url,
+                                headers = {"Accept" : NTRIPLES_ACCEPT})
+    if type.startswith("application/rdf+xml"):
+        return rdfxml_to_ntriples(data)
+    return data
+
+def rdfxml_to_ntriples(data):
+    """Converts the simple RDF/XML produced by sdshare-server (a list of
+    rdf:Description elements with literal or rdf:resource properties)
+    to N-Triples."""
+    lines = []
+    for desc in ElementTree.fromstring(data):
+        subject = desc.get(RDF + "about")
+        for prop in desc:
+            uri = prop.tag[1 : ].replace("}", "", 1)
+            resource = prop.get(RDF + "resource")
+            if resource is not None:
+                object = "<%s>" % resource
+            else:
+                object = '"%s"' % escape_literal(prop.text or "")
+            lines.append("<%s> <%s> %s .\n" % (subject, uri, object))
+    return "".join(lines)
+
+def escape_literal(value):
+    value = (value.replace("\\", "\\\\").replace('"', '\\"')
+             .replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t"))
+    if isinstance(value, unicode):
+        value = "".join([escape_char(ch) for ch in value])
+    return value
+
+def escape_char(ch):
+    if ord(ch) < 0x80:
+        return str(ch)
+    elif ord(ch) < 0x10000:
+        return "\\u%04X" % ord(ch)
+    return "\\U%08X" % ord(ch)
+
+# --- CHECKPOINTS
+
+class Checkpoints:
+    """Remembers the (since, after) position reached in each feed, in a
+    file with one tab-separated line per feed. The file is replaced
+    atomically each time a position is saved."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._positions = {}
+        if os.path.exists(filename):
+            for line in open(filename):
+                (feed, since, after) = line.rstrip("\n").split("\t")
+                self._positions[feed] = (since, after)
+
+    def get(self, feed):
+        return self._positions.get(feed)
+
+    def set(self, feed, since, after):
+        self._positions[feed] = (since, after)
+        tmpname = self._filename + ".tmp"
+        outf = open(tmpname, "w")
+        for (feed, (since, after)) in self._positions.items():
+            outf.write("%s\t%s\t%s\n" % (feed, since, after))
+        outf.close()
+        os.rename(tmpname, self._filename)
+
+# --- SYNCING
+
+def sync(feedurl, writer, checkpoints, pool):
+    """Reads the fragments feed from the saved position to the end,
+    writing one page of fragments at a time. Returns the number of
+    fragments written."""
+    url = feedurl
+    position = checkpoints.get(feedurl)
+    if position:
+        url += "?" + urllib.urlencode([("since", position[0]),
+                                       ("after", position[1])])
+
+    count = 0
+    while url:
+        (entries, url) = read_page(url)
+        if not entries:
+            break
+
+        fragments = pool.map(fetch_fragment,
+                             [fragurl for (id, updated, fragurl) in entries])
+        writer("".join(fragments))
+
+        (id, updated, fragurl) = entries[-1]
+        checkpoints.set(feedurl, updated, id)
+        count += len(entries)
+    return count
+
+def post_to_writer(writerurl):
+    """Returns a function that sends N-Triples to sdshare-writer's /bulk.
+    While the writer's queue is full, it waits as long as the writer
+    asks and tries again. If the writer reports errors for any of the
+    resources, it raises SDshareError, so that the checkpoint isn't
+    moved past them and the page is sent again next time."""
+    def write(ntriples):
+        while True:
+            try:
+                (summary, type) = http.request("POST", writerurl, ntriples,
+                                               {"Content-Type" : "text/plain"})
+                break
+            except Unavailable, e:
+                print >>sys.stderr, "%s, retrying in %s seconds" % \
+                      (e, e.retry_after)
+                time.sleep(e.retry_after)
+        errors = [line for line in summary.splitlines() if " error: " in line]
+        for line in errors:
+            print >>sys.stderr, line
+        if errors:
+            raise SDshareError("writer failed to write %s resources" %
+                               len(errors))
+    return write
+
+def print_ntriples(ntriples):
+    sys.stdout.write(ntriples)
+
+# --- MAIN
+
+if __name__ == "__main__":
+    parser = OptionParser(usage = "%prog [options] <fragments feed url>...")
+    parser.add_option("-w", "--writer", dest = "writer",
+                      help = "url of sdshare-writer's /bulk endpoint "
+                             "(default: print N-Triples to stdout)")
+    parser.add_option("-n", "--workers", dest = "workers", type = "int",
+                      default = WORKERS,
+                      help = "number of fragments to fetch in parallel")
+    parser.add_option("-c", "--checkpoints", dest = "checkpoints",
+                      default = CHECKPOINT_FILE,
+                      help = "file to save the feed positions in")
+    parser.add_option("-i", "--interval", dest = "interval", type = "int",
+                      default = POLL_INTERVAL,
+                      help = "seconds to wait between polls")
+    parser.add_option("--once", dest = "once", action = "store_true",
+                      help = "read each feed to the end once, then stop")
+    (options, feeds) = parser.parse_args()
+    if not feeds:
+        parser.error("no fragments feeds given")
+
+    if options.writer:
+        writer = post_to_writer(options.writer)
+    else:
+        writer = print_ntriples
+    checkpoints = Checkpoints(options.checkpoints)
+    pool = ThreadPool(options.workers)
+
+    while True:
+        failed = False
+        for feed in feeds:
+            # the checkpoint only moves once a page is written, so after
+            # an error the feed is simply read from there next time
+            try:
+                count = sync(feed, writer, checkpoints, pool)
+            except (SDshareError, httplib.HTTPException, socket.error,
+                    SyntaxError), e: # SyntaxError covers XML parse errors
+                print >>sys.stderr, "%s: failed: %s" % (feed, e)
+                failed = True
+                continue
+            if count:
+                print >>sys.stderr, "%s: %s fragments" % (feed, count)
+        if options.once:
+            sys.exit(failed and 1 or 0)
+        time.sleep(options.interval)
@@ -0,0 +1,154 @@
+"""
+Metrics and profiling shared by sdshare-server and sdshare-writer. Each
+tool adds this directory to sys.path and imports what it needs; every
+process gets its own metrics and profiler.
+"""
+
+import sys, os, time, threading, thread
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0) # seconds
+PROFILE_INTERVAL = 0.01 # seconds between stack samples
+MAX_PROFILE_TIME = 60 # seconds
+
+class Metrics:
+    """Thread-safe counters and latency histograms, rendered in the
+    Prometheus text format. Each process has its own numbers."""
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counters = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(self._buckets), 0.0, 0]
+                self._histograms[key] = histogram
+            for ix in range(len(self._buckets)):
+                if value <= self._buckets[ix]:
+                    histogram[0][ix] += 1
+            histogram[1] += value
+            histogram[2] += 1
+        finally:
+            self._lock.release()
+
+    def render(self):
+        self._lock.acquire()
+        try:
+            counters = sorted(self._counters.items())
+            histograms = sorted([(key, (list(counts), total, count))
+                                 for (key, (counts, total, count))
+                                 in self._histograms.items()])
+        finally:
+            self._lock.release()
+
+        lines = []
+        typed = set()
+        for ((name, labels), value) in counters:
+            if name not in typed:
+                lines.append("# TYPE %s counter" % name)
+                typed.add(name)
+            lines.append("%s%s %s" % (name, format_labels(labels), value))
+        for ((name, labels), (counts, total, count)) in histograms:
+            if name not in typed:
+                lines.append("# TYPE %s histogram" % name)
+                typed.add(name)
+            for ix in range(len(self._buckets)):
+                lines.append("%s_bucket%s %s" %
+                             (name, format_labels(labels + (("le", self._buckets[ix]), )),
+                              counts[ix]))
+            lines.append("%s_bucket%s %s" %
+                         (name, format_labels(labels + (("le", "+Inf"), )), count))
+            lines.append("%s_sum%s %s" % (name, format_labels(labels), total))
+            lines.append("%s_count%s %s" % (name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (name, str(value).replace('"', '\\"'))
+                              for (name, value) in labels])
+
+metrics = Metrics()
+
+def request_counter(prefix):
+    """Returns WSGI middleware which counts the requests to each
+    endpoint and how long they take, as prefix_requests_total and
+    prefix_request_seconds. For streamed responses the time is up to
+    the first chunk, since web.py produces that before returning."""
+    def count_requests(wsgiapp):
+        def serve(environ, start_response):
+            endpoint = "/" + environ.get("PATH_INFO", "/").split("/")[1]
+            status = []
+            def record_status(code, headers, exc_info = None):
+                status.append(code.split(" ", 1)[0])
+                return start_response(code, headers, exc_info)
+
+            start = time.time()
+            try:
+                return wsgiapp(environ, record_status)
+            finally:
+                metrics.observe(prefix + "_request_seconds",
+                                time.time() - start, endpoint = endpoint)
+                metrics.inc(prefix + "_requests_total", endpoint = endpoint,
+                            status = (status or ["500"])[0])
+        return serve
+    return count_requests
+
+class SamplingProfiler:
+    """Samples the stacks of all other threads every PROFILE_INTERVAL
+    seconds, counting how often each stack is seen. Only one profile
+    can run at a time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def start(self, seconds):
+        """Samples for the given number of seconds, returning False if
+        another profile is already running."""
+        if not self._lock.acquire(False):
+            return False
+        try:
+            self._counts = {}
+            me = thread.get_ident()
+            end = time.time() + seconds
+            while time.time() < end:
+                for (ident, frame) in sys._current_frames().items():
+                    if ident != me:
+                        key = format_stack(frame)
+                        self._counts[key] = self._counts.get(key, 0) + 1
+                time.sleep(PROFILE_INTERVAL)
+            return True
+        finally:
+            self._lock.release()
+
+    def get_folded(self):
+        "Returns 'frame;frame;frame count' lines, most common stack first."
+        stacks = sorted(self._counts.items(), key = lambda (k, v): -v)
+        return "".join(["%s %s\n" % (key, count) for (key, count) in stacks])
+
+def format_stack(frame):
+    "Returns the stack as 'file:function;file:function...', outermost first."
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+profiler = SamplingProfiler()
@@ -0,0 +1,339 @@
+"""
+Benchmarks for the SDshare server. Run with
+
+    python benchmark.py [options] [rows]
+
+to generate a CSV file with the given number of rows (default
+10,000,000) and measure how long it takes to load, how much memory it
+takes, how fast fragments feed pages, fragments and snapshots are
+rendered, and how Serializer compares to the old Resource-based
+rendering. It also pages through SQL feeds over sqlite, checking
+that every row comes out exactly once. Use --json to save the
+results, and --compare to see how they differ from results saved
+earlier.
+"""
+
+import os, sys, time, imp, tempfile, random, gc, resource, platform
+import sqlite3
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+appdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, appdir)
+server = imp.load_source('sdshare_server',
+                         os.path.join(appdir, 'sdshare-server.py'))
+
+CUSTOMER = "http://example.org/ont/Customer"
+PATTERN = "http://example.org/data/customer/%(ID)s"
+COLUMNS = [("NAME", "http://example.org/ont/name"),
+           ("ADDRESS1", "http://example.org/ont/address-1"),
+           ("ADDRESS2", "http://example.org/ont/address-2"),
+           ("ZIP", "http://example.org/ont/zip-code"),
+           ("PLACE", "http://example.org/ont/place")]
+PAGES = 100 # fragments feed pages to render
+SQL_ROWS = 100000 # at most this many rows in the sqlite table
+
+def make_columns(count):
+    """Returns count (column, property) pairs: the customers.csv
+    columns first, then made-up ones."""
+    columns = COLUMNS[ : count]
+    for ix in range(len(columns), count):
+        columns.append(("EXTRA%s" % ix, "http://example.org/ont/extra-%s" % ix))
+    return columns
+
+def generate_csv(filename, rows, columns = COLUMNS):
+    "Writes a customers.csv lookalike with the given number of rows."
+    places = ["OSLO", "BERGEN", "STAVANGER", "TROMSO", "TRONDHEIM"]
+    extra = [column for (column, prop) in columns[len(COLUMNS) : ]]
+    outf = open(filename, 'wb')
+    outf.write(",".join(["ID"] + [column for (column, prop) in columns] +
+                        ["LASTMOD"]) + "\n")
+    for ix in xrange(rows):
+        values = {"NAME" : "Company %s AS" % ix,
+                  "ADDRESS1" : '"Street %s, bygning %s"' % (ix % 997, ix % 13),
+                  "ADDRESS2" : "",
+                  "ZIP" : "%04d" % (ix % 10000),
+                  "PLACE" : random.choice(places)}
+        for column in extra:
+            values[column] = "%s value %s" % (column.lower(), ix % 1009)
+        outf.write('%s,%s,2012-07-%02d %02d:%02d:%02d\n' %
+                   (ix, ",".join([values[column] for (column, p) in columns]),
+                    ix % 28 + 1, ix % 24, ix % 60, ix % 59))
+    outf.close()
+
+def generate_ntriples(filename, csvfile, columns = COLUMNS):
+    """Writes the rows of the CSV file as N-Triples, the way the server
+    would send them to sdshare-writer."""
+    outf = open(filename, 'wb')
+    for chunk in make_feed(csvfile, columns).snapshot(server.NTRIPLES):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        outf.write(chunk)
+    outf.close()
+
+def make_feed(filename, columns = COLUMNS):
+    feed = server.CSVFragmentFeed(filename, CUSTOMER, PATTERN, "LASTMOD")
+    for (column, prop) in columns:
+        feed.add_column(server.Column(column, prop))
+    return feed
+
+def make_collection(feed):
+    coll = server.Collection("Benchmark", "benchmark", None,
+                             server.Server("Benchmark", "benchmark.py"))
+    coll.add_feed(feed)
+    return coll
+
+class Results:
+    "Collects the measurements, printing each one as it comes in."
+
+    def __init__(self, rows, columns):
+        self.rows = rows
+        self.columns = columns
+        self.measurements = {}
+
+    def report(self, name, rows, bytes, secs, key = None):
+        print "%-10s %10d rows %8.1f s %10.0f rows/s %8.1f MB/s" % \
+              (name, rows, secs, rows / secs, bytes / secs / (1024.0 * 1024))
+        self.add(key or name, rows_per_sec = rows / secs,
+                 mb_per_sec = bytes / secs / (1024.0 * 1024))
+
+    def add(self, name, **values):
+        self.measurements.setdefault(name, {}).update(values)
+
+    def to_json(self):
+        return {"time" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python" : platform.python_version(),
+                "rows" : self.rows,
+                "columns" : self.columns,
+                "results" : self.measurements}
+
+def bench_snapshot(results, filename, rows, columns):
+    for (name, syntax) in (("snapshot", server.RDFXML),
+                           ("ntriples", server.NTRIPLES)):
+        feed = make_feed(filename, columns)
+        size = 0
+        start = time.time()
+        for chunk in feed.snapshot(syntax):
+            size += len(chunk)
+        secs = time.time() - start
+        results.report(name, rows, size, secs)
+
+def render_resource(feed, uri, obj, decls = None):
+    "Renders a row the old way, through Resource."
+    resource = server.Resource(uri, feed.get_type())
+    for col in feed._columns:
+        value = col.get_value(obj)
+        if value:
+            resource.add_property(col.get_property(), value, col.is_literal())
+    if decls is not None:
+        return resource.render(decls)
+    decls = resource.get_ns_decls()
+    return (server.RDF_HEADER + server.render_ns_decls(decls) + '>\n' +
+            resource.render(decls) + server.RDF_FOOTER)
+
+def bench_render(results, filename, rows, columns):
+    feed = make_feed(filename, columns)
+    rows = min(rows, 200000) # enough to get stable numbers
+    objs = []
+    for obj in feed._stream_rows():
+        objs.append((PATTERN % obj, obj))
+        if len(objs) == rows:
+            break
+
+    serializer = feed.get_serializer()
+    start = time.time()
+    new = [serializer.render_fragment(uri, obj) for (uri, obj) in objs]
+    newsecs = time.time() - start
+    start = time.time()
+    old = [render_resource(feed, uri, obj) for (uri, obj) in objs]
+    oldsecs = time.time() - start
+    assert old == new
+    results.report("fragment", rows, sum(map(len, new)), newsecs)
+    results.report("  (old)", rows, sum(map(len, old)), oldsecs,
+                   "fragment_old")
+
+    decls = feed._get_all_decls()
+    start = time.time()
+    new = ''.join(serializer.render_snapshot([obj for (uri, obj) in objs],
+                                             PATTERN))
+    newsecs = time.time() - start
+    start = time.time()
+    old = ''.join([render_resource(feed, uri, obj, decls)
+                   for (uri, obj) in objs])
+    oldsecs = time.time() - start
+    assert old in new
+    results.report("rendering", rows, len(new), newsecs)
+    results.report("  (old)", rows, len(old), oldsecs, "rendering_old")
+
+def get_rss():
+    "Returns the resident set size of this process in bytes."
+    try:
+        pages = int(open("/proc/self/statm").read().split()[1])
+        return pages * resource.getpagesize()
+    except IOError:
+        # not Linux, so settle for the peak value (in kB on most systems)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_memory(results, filename, rows, columns):
+    """Loads the file, then renders fragments feed pages starting at
+    random positions in it."""
+    feed = make_feed(filename, columns)
+    gc.collect()
+    before = get_rss()
+    start = time.time()
+    feed.load()
+    secs = time.time() - start
+    gc.collect()
+    used = get_rss() - before
+    results.report("load", rows, os.path.getsize(filename), secs)
+    print "%-10s %10.0f bytes/row in memory (%.0f in the file)" % \
+          ("", used / float(rows), os.path.getsize(filename) / float(rows))
+    results.add("load", bytes_per_row = used / float(rows))
+
+    coll = make_collection(feed)
+    index = feed._index
+    times = []
+    for ix in xrange(PAGES):
+        row = random.choice(index)
+        start = time.time()
+        unicode(server.render.fragments(coll, row[0], row[1]))
+        times.append(time.time() - start)
+    times.sort()
+    average = sum(times) / len(times)
+    p95 = times[int(len(times) * 0.95)]
+    print "%-10s %10d pages %7.1f ms/page %7.1f ms at p95" % \
+          ("page", PAGES, average * 1000, p95 * 1000)
+    results.add("page", ms_per_page = average * 1000, ms_p95 = p95 * 1000)
+
+def bench_sql(results, rows):
+    """Pages through SQL feeds over sqlite tables the way the client
+    would, checking that every row is seen exactly once: first a single
+    table whose timestamps are strings with a T in the middle, then a
+    collection of two tables with whole-second timestamps. Many rows
+    share each timestamp, so the since/after paging is exercised too."""
+    rows = min(rows, SQL_ROWS)
+    (fd, dbfile) = tempfile.mkstemp(suffix = '.db')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(dbfile)
+        create_sql_table(conn, "customers", xrange(rows), "T")
+        create_sql_table(conn, "even", xrange(0, rows, 2), " ")
+        create_sql_table(conn, "odd", xrange(1, rows, 2), " ")
+        conn.close()
+
+        pool = server.ConnectionPool(sqlite3, {"database" : dbfile})
+        (pages, secs) = page_through(make_sql_feed(pool, "customers"), rows)
+        print "%-10s %10d pages %7.1f ms/page" % ("sql", pages,
+                                                    secs * 1000 / pages)
+        results.add("sql", ms_per_page = secs * 1000 / pages)
+
+        coll = make_collection(make_sql_feed(pool, "even"))
+        coll.add_feed(make_sql_feed(pool, "odd"))
+        (pages, secs) = page_through(coll, rows)
+        print "%-10s %10d pages %7.1f ms/page" % ("sql-multi", pages,
+                                                    secs * 1000 / pages)
+        results.add("sql-multi", ms_per_page = secs * 1000 / pages)
+    finally:
+        os.unlink(dbfile)
+
+def create_sql_table(conn, table, ids, separator):
+    """Rows ix and ix + 1 get the same timestamp when ix is even, so
+    that the even and odd tables have timestamps in common."""
+    conn.execute("create table %s (id text, name text, lastmod text)" % table)
+    conn.executemany("insert into %s values (?, ?, ?)" % table,
+                     (("%s" % ix, "Company %s AS" % ix,
+                       "2012-07-%02d%s%02d:%02d:00" %
+                       (ix / 2 % 28 + 1, separator, ix / 2 % 24, ix / 2 % 7))
+                      for ix in ids))
+    conn.commit()
+
+def make_sql_feed(pool, table):
+    feed = server.SQLFragmentFeed(PATTERN, "id", "lastmod", table,
+                                  CUSTOMER, pool)
+    feed.add_column(server.Column("name", "http://example.org/ont/name"))
+    return feed
+
+def page_through(source, rows):
+    """Follows the next links of a feed or collection to the end,
+    raising AssertionError unless each of the rows is seen once.
+    Returns (pages, seconds)."""
+    seen = set()
+    pages = 0
+    start = time.time()
+    page = source.get_fragments(None)
+    while True:
+        pages += 1
+        for fragment in page.get_fragments():
+            if fragment.get_id() in seen:
+                raise AssertionError("%s seen twice, on page %s" %
+                                     (fragment.get_id(), pages))
+            seen.add(fragment.get_id())
+        if not page.has_next_page():
+            break
+        last = page.get_fragments()[-1]
+        page = source.get_fragments(server.parse_atom(last.get_updated()),
+                                    last.get_id())
+    secs = time.time() - start
+    if len(seen) != rows:
+        raise AssertionError("saw %s of %s rows" % (len(seen), rows))
+    return (pages, secs)
+
+def compare(results, filename):
+    """Prints the change in each measurement since the results in the
+    file. For rates higher is better, for times and sizes lower is."""
+    old = json.load(open(filename))
+    print
+    print "Compared to %s (%s rows, %s columns, %s):" % \
+          (filename, old["rows"], old["columns"], old["time"])
+    for (name, values) in sorted(results.measurements.items()):
+        for (key, value) in sorted(values.items()):
+            before = old["results"].get(name, {}).get(key)
+            if before:
+                print "  %-28s %12.1f -> %12.1f %+7.1f%%" % \
+                      ("%s.%s" % (name, key), before, value,
+                       (value - before) * 100.0 / before)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage = "%prog [options] [rows]")
+    parser.add_option("-c", "--columns", dest = "columns", type = "int",
+                      default = len(COLUMNS),
+                      help = "number of property columns (default %default)")
+    parser.add_option("--json", dest = "json",
+                      help = "save the results as JSON in this file")
+    parser.add_option("--compare", dest = "compare",
+                      help = "compare with results saved by --json")
+    parser.add_option("--ntriples", dest = "ntriples",
+                      help = "also save the data as N-Triples in this file "
+                             "(for sdshare-writer's benchmark)")
+    (options, args) = parser.parse_args()
+    rows = 10000000
+    if args:
+        rows = int(args[0])
+    columns = make_columns(options.columns)
+
+    (fd, filename) = tempfile.mkstemp(suffix = '.csv')
+    os.close(fd)
+    try:
+        print "Generating %s rows with %s columns..." % (rows, len(columns))
+        generate_csv(filename, rows, columns)
+        if options.ntriples:
+            generate_ntriples(options.ntriples, filename, columns)
+
+        results = Results(rows, len(columns))
+        bench_snapshot(results, filename, rows, columns)
+        bench_render(results, filename, rows, columns)
+        bench_memory(results, filename, rows, columns)
+        bench_sql(results, rows)
+    finally:
+        os.unlink(filename)
+
+    if options.json:
+        outf = open(options.json, 'w')
+        json.dump(results.to_json(), outf, indent = 2, sort_keys = True)
+        outf.close()
+    if options.compare:
+        compare(results, options.compare)
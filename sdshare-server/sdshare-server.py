@@ -3,10 +3,21 @@ A simple SDShare server with pluggable backends based on web.py. The
 code is very much prototype quality.
 """
 
-import os, datetime, cgi, time, traceback, sys, csv
+import os, datetime, cgi, time, traceback, sys, csv, urllib, bisect, signal
+import threading, Queue, collections, hashlib, re, zlib, fcntl, logging
+import heapq, itertools
 import web
 from xml.sax import make_parser
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 from saxtracker import SAXTracker
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "sdshare-common"))
+from instrumentation import metrics, profiler, request_counter, \
+     MAX_PROFILE_TIME
  
 urls = (
     '/', 'OverviewFeed',
@@ -15,51 +26,199 @@ urls = (
     '/fragment/([^/]+)/(.+)', 'FragmentService',
     '/snapshots/(.+)', 'SnapshotsFeed',
     '/snapshot/(.+)', 'SnapshotService',
+    '/metrics', 'MetricsService',
+    '/profile', 'ProfileService',
+    '/ready', 'ReadyService',
     )
  
 PAGE_SIZE = 1000
 BATCH_SIZE = 10000
+FRAGMENT_CACHE_SIZE = 64 * 1024 * 1024 # bytes of rendered fragments
+FEED_CACHE_SIZE = 4 * 1024 * 1024 # bytes of rendered Atom feeds
+ATOM_CACHE_SIZE = 100000 # formatted timestamps
+ROUTE_CACHE_SIZE = 100000 # fragment ids mapped to feeds
+SNAPSHOT_CHECK_INTERVAL = 10 # seconds between checks for stale snapshots
+LAST_CHANGED_TTL = 5 # seconds to reuse an SQL feed's max(timecol)
+
+log = logging.getLogger("sdshare-server")
  
 # --- PAGES
  
 class OverviewFeed:
     def GET(self):
         web.header("Content-Type", "application/atom+xml; charset=utf-8")
-        return render.overview_feed(server)
+        # polling the overview mustn't make collections load
+        return serve_feed(("overview", ), server.get_last_changed(False),
+                          lambda: render.overview_feed(server))
  
 class CollectionFeed:
     def GET(self, id):
         web.header("Content-Type", "application/atom+xml; charset=utf-8")
-        coll = server.get_collection_by_id(id)
-        return render.collection(coll)
+        coll = get_collection(id)
+        return serve_feed(("collection", id), coll.get_last_changed(),
+                          lambda: render.collection(coll))
  
 class FragmentsFeed:
     def GET(self, id):
         web.header("Content-Type", "application/atom+xml; charset=utf-8")
-        params = web.input(since = None)
-        coll = server.get_collection_by_id(id)
-        return render.fragments(coll, params.since)
+        params = web.input(since = None, after = None)
+        try:
+            since = params.since and parse_atom(params.since)
+        except ValueError:
+            raise web.badrequest()
+        coll = get_collection(id)
+        return render.fragments(coll, since, params.after)
  
 class SnapshotsFeed:
     def GET(self, id):
         web.header("Content-Type", "application/atom+xml; charset=utf-8")
-        coll = server.get_collection_by_id(id)
-        return render.snapshots(coll)
+        coll = get_collection(id)
+        # a new snapshot file changes the feed even if the data didn't
+        info = coll.get_snapshot_info()
+        updated = coll.get_last_changed()
+        if info:
+            updated = latest([updated, info[0]])
+        return serve_feed(("snapshots", id, info), updated,
+                          lambda: render.snapshots(coll))
  
 class FragmentService:
     def GET(self, collid, fragid):
-        web.header("Content-Type", "application/rdf+xml; charset=utf-8")
-        coll = server.get_collection_by_id(collid)
-        frag = coll.get_fragment_by_id(fragid)
-        return frag.render()
+        syntax = negotiate_syntax(web.ctx.env.get("HTTP_ACCEPT"))
+        web.header("Content-Type", syntax + "; charset=utf-8")
+        web.header("Vary", "Accept")
+        coll = get_collection(collid)
+        try:
+            frag = coll.get_fragment_by_id(fragid)
+        except KeyError:
+            raise web.notfound()
+
+        # the rendering only changes when the fragment is updated, so
+        # the key doubles as the ETag, and 304s never render anything
+        key = (collid, fragid, frag.get_updated(), syntax)
+        web.modified(frag.get_last_modified(), make_etag(key))
+
+        body = fragment_cache.get(key)
+        if body is None:
+            body = frag.render(syntax)
+            fragment_cache.put(key, body)
+        return body
  
 class SnapshotService:
     def GET(self, id):
-        web.header("Content-Type", "application/rdf+xml; charset=utf-8")
-        web.header('Transfer-Encoding', 'chunked')       
-        coll = server.get_collection_by_id(id)
-        for chunk in coll.snapshot():
-            yield chunk
+        # no Content-Length, so the HTTP server will stream the chunks.
+        # Transfer-Encoding is for the server to set, not WSGI apps.
+        # materialized snapshots never get here; see serve_snapshot_files
+        syntax = negotiate_syntax(web.ctx.env.get("HTTP_ACCEPT"))
+        web.header("Content-Type", syntax + "; charset=utf-8")
+        web.header("Vary", "Accept, Accept-Encoding")
+        coll = get_collection(id)
+        chunks = coll.snapshot(syntax)
+        if "gzip" in parse_accept(web.ctx.env.get("HTTP_ACCEPT_ENCODING")):
+            web.header("Content-Encoding", "gzip")
+            chunks = gzip_stream(chunks)
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        finally:
+            metrics.inc("sdshare_snapshot_bytes_total", size,
+                        source = "rendered")
+
+class MetricsService:
+    def GET(self):
+        web.header("Content-Type", "text/plain; version=0.0.4")
+        return metrics.render()
+
+class ProfileService:
+    def GET(self):
+        """Samples the stacks of all threads for the given number of
+        seconds, then returns them in the folded format flamegraph.pl
+        takes. Only available if the profiling param is true."""
+        if not server.get_profiling():
+            raise web.notfound()
+        try:
+            seconds = float(web.input(seconds = "10").seconds)
+        except ValueError:
+            raise web.badrequest()
+        if not profiler.start(min(seconds, MAX_PROFILE_TIME)):
+            raise web.conflict() # someone else is profiling
+        web.header("Content-Type", "text/plain")
+        return profiler.get_folded()
+
+class ReadyService:
+    def GET(self):
+        """Lists the load state of each collection, with status 503
+        until all of them are ready, so that load balancers can hold
+        off until the server has warmed up."""
+        web.header("Content-Type", "text/plain")
+        if not server.is_ready():
+            web.ctx.status = "503 Service Unavailable"
+        lines = []
+        for (id, state, secs) in server.get_states():
+            if secs is None:
+                lines.append("%s %s\n" % (id, state))
+            else:
+                lines.append("%s %s %.1f\n" % (id, state, secs))
+        return "".join(lines)
+
+def negotiate_syntax(accept):
+    "Picks the syntax to return from the value of the Accept header."
+    best = RDFXML
+    bestq = 0.0
+    for (type, q) in parse_accept(accept).items():
+        if type in SERIALIZERS and q > bestq:
+            (best, bestq) = (type, q)
+    return best
+
+def parse_accept(header):
+    """Parses an Accept or Accept-Encoding header into a dict of
+    values to q values, leaving out the ones with q = 0."""
+    values = {}
+    for part in (header or "").split(","):
+        fields = part.split(";")
+        value = fields[0].strip().lower()
+        q = 1.0
+        for param in fields[1 : ]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    q = float(param[2 : ])
+                except ValueError:
+                    pass
+        if value and q > 0:
+            values[value] = q
+    return values
+
+def gzip_stream(chunks):
+    "Compresses a stream of chunks on the fly."
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def get_collection(id):
+    coll = server.get_collection_by_id(id)
+    if not coll:
+        raise web.notfound()
+    return coll
+
+def serve_feed(key, updated, render_feed):
+    """Serves a feed that only changes when the data does, handling
+    conditional GET and rendering it only if it isn't in the cache.
+    updated is the last time the data changed."""
+    key = key + (updated, )
+    web.modified(updated and to_datetime(updated), make_etag(key))
+
+    body = feed_cache.get(key)
+    if body is None:
+        body = unicode(render_feed())
+        feed_cache.put(key, body)
+    return body
  
 # --- INTERNAL DATA MODEL
  
@@ -72,6 +231,12 @@ class Server:
         self._title = title
         self._author = author
         self._collections = []
+        self._collections_by_id = {}
+        self._snapshot_dir = None
+        self._snapshot_gzip = False
+        self._snapshot_store = None
+        self._profiling = False
+        self._states = {} # collection id -> (state, seconds to load)
  
     def get_title(self):
         return self._title
@@ -84,14 +249,60 @@ class Server:
  
     def add_collection(self, collection):
         self._collections.append(collection)
+        self._collections_by_id[collection.get_id()] = collection
  
     def get_collection_by_id(self, id):
+        return self._collections_by_id.get(id)
+
+    def load(self, threads = 1):
+        """Loads all collections into memory, the given number at a
+        time. A collection that fails to load is logged and marked as
+        failed, but doesn't stop the others."""
         for coll in self._collections:
-            if coll.get_id() == id:
-                return coll
+            self._states[coll.get_id()] = ("waiting", None)
+        pool = ThreadPool(threads)
+        try:
+            pool.map(self._load_collection, self._collections, 1)
+        finally:
+            pool.close()
+        log.info("collections loaded ready=%s", self.is_ready())
+
+    def _load_collection(self, coll):
+        id = coll.get_id()
+        self._states[id] = ("loading", None)
+        start = time.time()
+        try:
+            coll.load()
+        except Exception:
+            log.exception("loading collection failed id=%s", id)
+            self._states[id] = ("failed", time.time() - start)
+            return
+        secs = time.time() - start
+        self._states[id] = ("ready", secs)
+        metrics.inc("sdshare_collections_loaded_total")
+        log.info("collection loaded id=%s secs=%.1f", id, secs)
+
+    def get_states(self):
+        """Returns (collection id, state, seconds to load) for every
+        collection. The state is lazy if load() hasn't been called, then
+        waiting, loading, and finally ready or failed."""
+        return [(coll.get_id(), ) +
+                self._states.get(coll.get_id(), ("lazy", None))
+                for coll in self._collections]
+
+    def is_ready(self):
+        "True unless collections are still loading or failed to load."
+        return not [id for (id, state, secs) in self.get_states()
+                    if state not in ("lazy", "ready")]
+
+    def get_last_changed(self, load = True):
+        """Returns the timestamp of the last change in any collection, or
+        None. See FragmentFeed.get_last_changed for load."""
+        return latest([coll.get_last_changed(load)
+                       for coll in self._collections])
 
     def get_timestamp(self):
-        return now_timestamp()
+        return format_updated(self.get_last_changed(False))
             
     def set_author(self, author):
         self._author = author
@@ -99,10 +310,33 @@ class Server:
     def set_title(self, title):
         self._title = title
 
+    def set_snapshot_dir(self, dir):
+        self._snapshot_dir = dir
+
+    def set_snapshot_gzip(self, value):
+        self._snapshot_gzip = (value.strip() == "true")
+
+    def set_profiling(self, value):
+        self._profiling = (value.strip() == "true")
+
+    def get_profiling(self):
+        return self._profiling
+
+    def get_snapshot_store(self):
+        "Returns the SnapshotStore, or None if snapshots aren't materialized."
+        if self._snapshot_dir and not self._snapshot_store:
+            self._snapshot_store = SnapshotStore(self._snapshot_dir,
+                                                 self._snapshot_gzip)
+        return self._snapshot_store
+
     def get_guid(self):
         return "http://www.example.org/collections" # FIXME
             
 class Collection:
+    """A collection made from one or more feeds. With several feeds the
+    fragments feed merges theirs in order of (updated, feed), and the
+    snapshot has the rows of each feed in turn. Fragment ids must be
+    unique across the feeds."""
  
     def __init__(self, title, id, uri, server):
         self._title = title
@@ -110,6 +344,7 @@ class Collection:
         self._uri = uri
         self._server = server
         self._feeds = []
+        self._routes = {} # fragment id -> index of its feed
  
     def get_title(self):
         return self._title
@@ -129,59 +364,206 @@ class Collection:
     def get_feeds(self):
         return self._feeds
  
-    def get_updated(self):
-        return now_timestamp()
+    def get_updated(self, load = True):
+        return format_updated(self.get_last_changed(load))
+
+    def get_last_changed(self, load = True):
+        "Returns the timestamp of the last change in any feed, or None."
+        return latest([feed.get_last_changed(load) for feed in self._feeds])
  
     def add_feed(self, feed):
         self._feeds.append(feed)
+
+    def load(self):
+        for feed in self._feeds:
+            feed.load()
  
-    def get_fragments(self, since):
-        return self._feeds[0].get_fragments(since)
+    def get_fragments(self, since, after = None):
+        if len(self._feeds) == 1:
+            return self._feeds[0].get_fragments(since, after)
+
+        # the fragment we're continuing after sorts after all those in
+        # earlier feeds with the same timestamp, and before all those in
+        # later feeds, so each feed starts at a different place
+        position = None
+        if since and after is not None:
+            position = self._find_fragment(after)[0]
+        sources = []
+        for ix in range(len(self._feeds)):
+            feed = self._feeds[ix]
+            if position is None:
+                page = feed.get_fragments(since, after)
+            elif ix < position:
+                page = feed.get_fragments(since, strict = True)
+            elif ix == position:
+                page = feed.get_fragments(since, after)
+            else:
+                page = feed.get_fragments(since)
+            sources.append([((frag.get_last_changed(), ix, n), frag)
+                            for (n, frag) in enumerate(page.get_all())])
+
+        fragments = []
+        for ((updated, ix, n), frag) in itertools.islice(heapq.merge(*sources),
+                                                         PAGE_SIZE + 1):
+            self._add_route(frag.get_id(), ix)
+            fragments.append(frag)
+        return FragmentPage(fragments)
  
     def get_fragment_by_id(self, id):
-        return self._feeds[0].get_fragment_by_id(id)
+        if len(self._feeds) == 1:
+            return self._feeds[0].get_fragment_by_id(id)
+        (ix, frag) = self._find_fragment(id)
+        if frag is None:
+            raise KeyError(id)
+        return frag
  
-    def snapshot(self):
-        for chunk in self._feeds[0].snapshot():
-            yield chunk
+    def snapshot(self, syntax = None):
+        syntax = syntax or RDFXML
+        if len(self._feeds) == 1:
+            return self._feeds[0].snapshot(syntax)
+        return self._snapshot_feeds(syntax)
+
+    def _snapshot_feeds(self, syntax):
+        "Streams the rows of each feed in turn, in a single document."
+        decls = extract_ns_decls([prop for feed in self._feeds
+                                  for prop in feed.get_properties()])
+        first = self._feeds[0].get_serializer(syntax)
+        yield first.render_header(decls)
+        for feed in self._feeds:
+            (rows, pattern) = feed.get_snapshot_rows()
+            serializer = feed.get_serializer(syntax)
+            for chunk in serializer.render_body(rows, pattern, decls):
+                yield chunk
+        yield first.render_footer()
+
+    def _find_fragment(self, id):
+        """Returns (index of feed, fragment) for the id, or (None, None).
+        Feeds are only searched if the id isn't in the routing index."""
+        ix = self._routes.get(id)
+        if ix is not None:
+            try:
+                return (ix, self._feeds[ix].get_fragment_by_id(id))
+            except KeyError:
+                pass # it's moved, or gone
+
+        for ix in range(len(self._feeds)):
+            try:
+                frag = self._feeds[ix].get_fragment_by_id(id)
+            except KeyError:
+                continue
+            self._add_route(id, ix)
+            return (ix, frag)
+        return (None, None)
+
+    def _add_route(self, id, ix):
+        if len(self._routes) >= ROUTE_CACHE_SIZE:
+            self._routes = {}
+        self._routes[id] = ix
+
+    def get_snapshot_info(self):
+        """Returns (updated, size) for the materialized snapshot, or None
+        if there isn't one."""
+        store = self._server.get_snapshot_store()
+        if store:
+            return store.get_info(self._id)
  
 class FragmentPage:
     """This class is used to wrap the list of fragments returned by
     the fragments feed, so that we can keep the paging logic in the
     Python code, rather than in the templates. It also helps us avoid
     having to duplicate it across different fragment feed
-    implementations."""
+    implementations.
+
+    Feeds should pass in up to PAGE_SIZE + 1 fragments, ordered by
+    (updated, id), so that we can tell whether there is a next page."""
  
-    def __init__(self, fragments, since, lastid):
+    def __init__(self, fragments):
         self._fragments = fragments
-        self._since = since
-        self._lastid = lastid
  
     def get_fragments(self):
         return self._fragments[ : PAGE_SIZE]
+
+    def get_all(self):
+        "Returns the fragments including the one beyond the page, if any."
+        return self._fragments
  
     def has_next_page(self):
         return len(self._fragments) > PAGE_SIZE
  
     def get_params(self):
-        "Produces the link parameters for the next page."
-        return "since=" + self._since
+        """Produces the link parameters for the next page. The next page
+        starts right after the (updated, id) of the last fragment on
+        this one, so fragments sharing a timestamp are not repeated."""
+        last = self._fragments[PAGE_SIZE - 1]
+        return urllib.urlencode([("since", last.get_updated()),
+                                 ("after", last.get_id())])
 
 class FragmentFeed:
-    "Abstract fragment feed class to define the interface."
+    """Abstract fragment feed class to define the interface. Subclasses
+    must set _type and _columns. Timestamps are passed around as
+    integer microseconds since the epoch, in UTC."""
+    _serializers = None
 
-    def get_fragments(self, since):
-        "since is a string."
+    def get_fragments(self, since, after = None, strict = False):
+        """since is a timestamp (or None), after is the id of the last
+        fragment on the previous page (or None). If strict is true, only
+        fragments updated after since are wanted, and after is None."""
         pass # returns a FragmentPage object
  
     def get_fragment_by_id(self, id):
         pass # returns a Fragment object
  
-    def snapshot(self):
-        pass # returns the actual snapshot in RDF/XML format
+    def get_snapshot_rows(self):
+        pass # returns (iterator over row dicts, uri pattern)
+
+    def snapshot(self, syntax = None):
+        "Returns the snapshot in the syntax (default RDF/XML), as chunks."
+        (rows, pattern) = self.get_snapshot_rows()
+        return self.get_serializer(syntax).render_snapshot(rows, pattern)
+
+    def get_last_changed(self, load = True):
+        """Returns a timestamp, or None if there is no data. If load is
+        false, feeds that keep their data in memory don't load it just
+        to answer, but return None if it isn't loaded yet."""
+        pass
+
+    def load(self):
+        pass # loads the data, for feeds that keep it in memory
+
+    def get_type(self):
+        return self._type
+
+    def add_column(self, column):
+        self._columns.append(column)
+
+    def get_properties(self):
+        return [col.get_property() for col in self._columns]
 
-class Fragment:
+    def get_serializer(self, syntax = None):
+        """Returns a serializer for the syntax (default RDF/XML). Must not
+        be called before all columns have been added."""
+        syntax = syntax or RDFXML
+        if self._serializers is None:
+            self._serializers = {}
+        serializer = self._serializers.get(syntax)
+        if not serializer:
+            serializer = SERIALIZERS[syntax](self._type, self._columns)
+            self._serializers[syntax] = serializer
+        return serializer
+
+    def _get_all_decls(self):
+        return extract_ns_decls([col.get_property() for col in self._columns])
+
+    def _add_properties(self, resource, fragment):
+        for col in self._columns:
+            value = col.get_value(fragment.get_values())
+            if value:
+                resource.add_property(col.get_property(), value,
+                                      col.is_literal())
+
+class Fragment(object):
     "Abstract fragment class, for reuse and to define interface."
+    __slots__ = ('_id', '_updated', '_feed')
  
     def __init__(self, id, updated, feed):
         self._id = id
@@ -193,6 +575,14 @@ class Fragment:
  
     def get_updated(self):
         return format_atom(self._updated)
+
+    def get_last_modified(self):
+        "Returns the updated value as a datetime."
+        return to_datetime(self._updated)
+
+    def get_last_changed(self):
+        "Returns the updated value as a timestamp."
+        return self._updated
  
     def get_syntax(self):
         return "application/rdf+xml"
@@ -200,90 +590,334 @@ class Fragment:
     def get_uri(self):
         return self._feed.make_uri(self._id)
  
-    def render(self):
-        pass
+    def render(self, syntax = None):
+        pass # returns the fragment in the syntax (default RDF/XML)
 
 # --- CSV backend
 
 class CSVFragmentFeed(FragmentFeed):
+    """Serves fragments from a CSV file. If reload is true the file is
+    stat-ed on every request: if it has only grown, the appended rows
+    are read, and if it has been rewritten, the whole file is diffed
+    against what we have, keyed on the fragment URI. Either way, only
+    fragments whose values actually changed get a new updated value.
+
+    To keep memory use down each row is stored as a single tuple of
+    (updated, uri, value, value, ...), holding only the columns that
+    are actually used. The same tuples make up both the uri lookup
+    table and the sorted index, and CSVFragment objects are created
+    as views on them when needed. Timestamps are parsed into integers
+    as the rows are read, so sorting and paging never touch strings."""
 
-    def __init__(self, source, type, pattern, timestampcol):
+    def __init__(self, source, type, pattern, timestampcol, reload = False,
+                 timestamps = None):
         self._source = source
-        self._type = type
-        self._pattern = pattern
+        # the rows are UTF-8 bytes, so these are too
+        self._type = to_utf8(type)
+        self._pattern = to_utf8(pattern)
         self._timestampcol = timestampcol
+        self._reload = reload
+        self._timestamps = timestamps or TimestampParser()
         self._columns = []
         self._loaded = False
-        self._fragments = {} # uri -> fragment
+        self._rows = {} # uri -> row tuple
+        self._index = [] # row tuples, sorted
+        self._lock = threading.Lock()
+        self._headers = None
+        self._names = None # names of the columns in the row tuples
+        self._ts_ix = None # position of the timestamp column in the tuples
+        self._stat = None # (inode, mtime, size) of the source as last read
+        self._offset = 0 # number of bytes of the source read so far
+        self._digest = None # md5 of those bytes, to detect rewrites
+        self._last_changed = None
 
-    def get_fragments(self, since):
-        if not self._loaded:
-            self._load()
-        
-        # FIXME: must interpret 'since'
-        subset = [f for f in self._fragments.values()
-                  if (not since) or f.get_updated() >= since]
-        lastid = None
-        if subset:
-            lastid = subset[-1].get_id()
+    def get_fragments(self, since, after = None, strict = False):
+        self._check_loaded()
+        after = to_utf8(after) # like the uris in the index
 
-        # FIXME: whoa! we can't do paging...
-        return FragmentPage(subset, since, lastid)
+        index = self._index
+        if not since:
+            start = 0
+        elif strict:
+            start = bisect.bisect_left(index, (since + 1, ))
+        elif after is None:
+            start = bisect.bisect_left(index, (since, ))
+        else:
+            # (since, after) sorts just before the row it came from
+            start = bisect.bisect_left(index, (since, after))
+            if start < len(index) and index[start][ : 2] == (since, after):
+                start += 1
+
+        rows = index[start : start + PAGE_SIZE + 1]
+        return FragmentPage([CSVFragment(self, row) for row in rows])
 
-    def get_type(self):
-        return self._type
-    
     def get_fragment_by_id(self, id):
-        if not self._loaded:
-            self._load()
-        return self._fragments[id]
- 
-    def snapshot(self):
-        if not self._loaded:
-            self._load()
-        all_decls = self._get_all_decls()
-        yield RDF_HEADER
-        yield render_ns_decls(all_decls) + '>\n'
-
-        for f in self._fragments.values():
-            resource = Resource(f.get_uri(), self._type)
-            self._add_properties(resource, f)
-            yield resource.render(all_decls)
-        
-        yield RDF_FOOTER
+        self._check_loaded()
+        return CSVFragment(self, self._rows[to_utf8(id)])
+
+    def get_last_changed(self, load = True):
+        if load or self._loaded:
+            self._check_loaded()
+        return self._last_changed
+
+    def load(self):
+        self._check_loaded()
 
     def add_column(self, column):
-        self._columns.append(column)
+        self._columns.append(column.to_utf8())
+ 
+    def get_snapshot_rows(self):
+        """Streams the snapshot straight from the CSV file, so that
+        memory use doesn't depend on the size of the file. Does not
+        require the feed to be loaded."""
+        return (self._stream_rows(), self._pattern)
 
-    def _get_all_decls(self):
-        return extract_ns_decls([col.get_property() for col in self._columns])
-        
-    def _load(self):
-        inf = open(self._source)
-        reader = csv.reader(inf)
-        headers = reader.next()
+    def _check_loaded(self):
+        if self._loaded and not self._reload:
+            return
 
-        for row in reader:
-            obj = {}
-            for ix in range(len(row)):
-                value = row[ix].strip()
-                if value:
-                    obj[headers[ix]] = value
+        self._lock.acquire()
+        try:
+            if not self._loaded:
+                self._load()
+            else:
+                self._refresh()
+        finally:
+            self._lock.release()
 
-            uri = self._pattern % obj
-            # FIXME: must interpret timestamp into comparable value
-            frag = CSVFragment(uri, obj[self._timestampcol], self, obj)
-            self._fragments[uri] = frag
-        
-        inf.close()
+    def _load(self):
+        inf = open(self._source, 'rb')
+        stat = stat_key(os.fstat(inf.fileno()))
+        lines = LineCounter(inf, 0, self._reload, hashlib.md5())
+        reader = csv.reader(lines)
+        try:
+            self._headers = [intern(header) for header in reader.next()]
+        except StopIteration:
+            # empty, or no complete header yet, so most likely being
+            # written right now; try again on the next request
+            inf.close()
+            log.warning("no header in source=%s", self._source)
+            return
+        self._stat = stat
+        self._init_names()
+
+        start = time.time()
+        rows = self._rows
+        count = 0
+        try:
+            for (updated, uri, obj) in self._read_rows(reader, self._headers):
+                rows[uri] = self._make_row(updated, uri, obj)
+                count += 1
+        finally:
+            inf.close()
+        (self._offset, self._digest) = (lines.offset, lines.digest)
+        self._index = sorted(rows.itervalues())
+        if self._index:
+            self._last_changed = self._index[-1][0]
         self._loaded = True
+        metrics.inc("sdshare_rows_loaded_total", count)
+        log.info("loaded source=%s rows=%s secs=%.1f", self._source, count,
+                 time.time() - start)
 
-    def _add_properties(self, resource, fragment):
+    def _refresh(self):
+        try:
+            st = os.stat(self._source)
+        except OSError:
+            return # being replaced right now, most likely; try again later
+        if stat_key(st) == self._stat:
+            return
+
+        inf = open(self._source, 'rb')
+        try:
+            st = stat_key(os.fstat(inf.fileno()))
+            (inode, mtime, size) = st
+            # only if everything we read before is still there, byte for
+            # byte, can we just read on from where we stopped
+            appended = (inode == self._stat[0] and size >= self._offset and
+                        digest_prefix(inf, self._offset) ==
+                        self._digest.digest())
+
+            headers = self._headers
+            if appended:
+                inf.seek(self._offset)
+                lines = LineCounter(inf, self._offset, True,
+                                    self._digest.copy())
+                reader = csv.reader(lines)
+            else:
+                inf.seek(0)
+                lines = LineCounter(inf, 0, True, hashlib.md5())
+                reader = csv.reader(lines)
+                try:
+                    headers = [intern(header) for header in reader.next()]
+                except StopIteration:
+                    return # being replaced, most likely; try again later
+
+            # read everything before changing anything, so that if
+            # reading fails we are left as we were
+            rows = list(self._read_rows(reader, headers))
+        finally:
+            inf.close()
+
+        self._headers = headers
+        self._stat = st
+        (self._offset, self._digest) = (lines.offset, lines.digest)
+        self._apply_changes(rows, not appended)
+
+    def _apply_changes(self, rows, complete):
+        """Merges the (updated, uri, values) rows into the loaded
+        fragments. If complete is true the rows are the entire contents
+        of the source, and fragments not among them are removed."""
+        now = now_epoch()
+        seen = set()
+        removed = set()
+        added = []
+
+        for (updated, uri, obj) in rows:
+            seen.add(uri)
+            old = self._rows.get(uri)
+            row = self._make_row(updated, uri, obj)
+            if old is not None and self._same_values(old, row):
+                continue
+
+            if old is not None:
+                removed.add(old[ : 2])
+                if updated <= old[0]:
+                    # values changed, but timestamp didn't
+                    row = (now, ) + row[1 : ]
+            self._rows[uri] = row
+            added.append(row)
+
+        if complete:
+            for uri in [uri for uri in self._rows if uri not in seen]:
+                removed.add(self._rows[uri][ : 2])
+                del self._rows[uri]
+
+        metrics.inc("sdshare_rows_loaded_total", len(seen))
+        log.debug("reloaded source=%s rows=%s changed=%s removed=%s",
+                  self._source, len(seen), len(added), len(removed))
+        if removed or added:
+            # build a new list rather than modifying the one readers
+            # may be paging through right now
+            index = [row for row in self._index if row[ : 2] not in removed]
+            index.extend(added)
+            index.sort()
+            self._index = index
+            self._last_changed = now
+
+    def _init_names(self):
+        "Works out which columns we need to keep."
+        names = re.findall(r'%\((\w+)\)', self._pattern)
         for col in self._columns:
-            value = col.get_value(fragment.get_values())
-            if value:
-                resource.add_property(col.get_property(), value,
-                                      col.is_literal())
+            if col.get_name() not in names:
+                names.append(col.get_name())
+        self._names = [intern(name) for name in names]
+        if self._timestampcol in names:
+            self._ts_ix = names.index(self._timestampcol) + 2
+
+    def _make_row(self, updated, uri, obj):
+        return (updated, uri) + tuple([obj.get(name) for name in self._names])
+
+    def get_values(self, row):
+        "Turns a row tuple back into a dict."
+        obj = {}
+        for ix in range(len(self._names)):
+            value = row[ix + 2]
+            if value is not None:
+                obj[self._names[ix]] = value
+        return obj
+
+    def _same_values(self, row1, row2):
+        "Compares the values of two rows, ignoring the timestamp column."
+        ts = self._ts_ix
+        if ts is None:
+            return row1[2 : ] == row2[2 : ]
+        return (row1[2 : ts] == row2[2 : ts] and
+                row1[ts + 1 : ] == row2[ts + 1 : ])
+
+    def _stream_rows(self):
+        "Yields the rows of the CSV file as dicts, reading from disk."
+        inf = open(self._source, 'rb')
+        try:
+            reader = csv.reader(inf)
+            headers = reader.next()
+            for row in reader:
+                obj = {}
+                for ix in range(len(row)):
+                    value = row[ix].strip()
+                    if value:
+                        obj[headers[ix]] = value
+                yield obj
+        finally:
+            inf.close()
+
+    def _read_rows(self, reader, headers):
+        """Yields (updated, uri, values) for the rows in the reader.
+        Rows with a bad timestamp, or missing values the uri needs, are
+        logged and skipped."""
+        parse = self._timestamps.parse
+        for row in reader:
+            try:
+                obj = {}
+                for ix in range(len(row)):
+                    value = row[ix].strip()
+                    if value:
+                        obj[headers[ix]] = value
+                updated = parse(obj[self._timestampcol])
+                uri = self._pattern % obj
+            except (ValueError, KeyError, IndexError, TypeError), e:
+                log.warning("skipping row source=%s line=%s error=%r",
+                            self._source, reader.line_num, e)
+                metrics.inc("sdshare_rows_skipped_total")
+                continue
+            yield (updated, uri, obj)
+
+
+class LineCounter:
+    """Iterates over the lines in a file, counting how many bytes have
+    been consumed. If complete_only is true a last line with no line
+    ending is left alone, since it may be in the middle of being
+    written. If a hashlib digest is given the lines consumed are fed
+    to it."""
+
+    def __init__(self, inf, offset, complete_only = False, digest = None):
+        self._inf = inf
+        self._complete_only = complete_only
+        self.offset = offset
+        self.digest = digest
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self._inf.readline()
+        if not line or (self._complete_only and not line.endswith('\n')):
+            raise StopIteration()
+        self.offset += len(line)
+        if self.digest is not None:
+            self.digest.update(line)
+        return line
+
+def digest_prefix(inf, offset):
+    "Returns the md5 digest of the first offset bytes of the file."
+    digest = hashlib.md5()
+    inf.seek(0)
+    left = offset
+    while left:
+        block = inf.read(min(left, 1024 * 1024))
+        if not block:
+            break # file is shorter, so the digest won't match
+        digest.update(block)
+        left -= len(block)
+    return digest.digest()
+
+def to_utf8(value):
+    "Returns unicode as UTF-8, and anything else as it is."
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+def stat_key(st):
+    return (st.st_ino, st.st_mtime, st.st_size)
 
 def get_ns(prop):
     ix = prop.rfind('/')
@@ -300,7 +934,221 @@ def extract_ns_decls(properties):
  
 def render_ns_decls(decls):
     return '\n'.join(['xmlns:%s="%s"' % (pre, ns) for (ns, pre) in decls.items()])
+
+ESCAPE_CHARS = re.compile('[&<>]')
+
+def escape(value):
+    "Same as cgi.escape, but returns the value as is if nothing needs escaping."
+    if ESCAPE_CHARS.search(value) is None:
+        return value
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+class RDFXMLSerializer:
+    """Renders rows as RDF/XML, producing exactly the same output as
+    going through Resource, only faster. The markup for each column is
+    worked out once, up front, instead of for every property of every
+    row. There should be one serializer per feed."""
+
+    def __init__(self, type, columns):
+        self._columns = columns
+        self._props = [(col, get_ns(col.get_property()),
+                        col.get_property()[len(get_ns(col.get_property())) : ])
+                       for col in columns]
+        # the type goes into a format string, so any % in it is doubled
+        self._head = ('  <rdf:Description rdf:about="%s">\n' +
+                      '    <rdf:type rdf:resource="' +
+                      type.replace('%', '%%') + '"/>\n')
+        self._all_decls = extract_ns_decls([col.get_property()
+                                            for col in columns])
+        self._snapshot_tags = self._make_tags(self._all_decls)
+        self._fragment_tags = {} # column indexes -> (header, tags)
+
+    def render_snapshot(self, rows, pattern):
+        """Renders a snapshot from an iterator over row dicts, yielding
+        one chunk per BATCH_SIZE rows."""
+        yield self.render_header(self._all_decls)
+        for chunk in self.render_body(rows, pattern):
+            yield chunk
+        yield self.render_footer()
+
+    def render_header(self, decls):
+        return RDF_HEADER + render_ns_decls(decls) + '>\n'
+
+    def render_footer(self):
+        return RDF_FOOTER
+
+    def render_body(self, rows, pattern, decls = None):
+        """Renders the rows without the header and footer, using the
+        given namespace declarations (default: this feed's own), so
+        that several feeds can share a document."""
+        if decls is None:
+            tags = self._snapshot_tags
+        else:
+            tags = self._make_tags(decls)
+
+        head = self._head
+        props = zip(self._columns, tags)
+        buf = []
+        count = 0
+        for obj in rows:
+            buf.append(head % (pattern % obj))
+            first = True
+            for (col, (start, end)) in props:
+                value = col.get_value(obj)
+                if value:
+                    if not first:
+                        buf.append('\n')
+                    buf.append(start)
+                    buf.append(escape(value))
+                    buf.append(end)
+                    first = False
+            buf.append('\n  </rdf:Description>\n')
+
+            count += 1
+            if count == BATCH_SIZE:
+                yield ''.join(buf)
+                del buf[ : ]
+                count = 0
+
+        if buf:
+            yield ''.join(buf)
+
+    def render_fragment(self, uri, obj):
+        """Renders a single resource as a complete RDF/XML document. Only
+        namespaces actually used are declared, so the declarations
+        depend on which columns have values."""
+        values = []
+        for ix in range(len(self._columns)):
+            value = self._columns[ix].get_value(obj)
+            if value:
+                values.append((ix, value))
+
+        key = tuple([ix for (ix, value) in values])
+        (header, tags) = self._get_fragment_tags(key)
+
+        buf = [header, self._head % uri]
+        for (ix, value) in values:
+            (start, end) = tags[ix]
+            buf.append(start)
+            buf.append(escape(value))
+            buf.append(end)
+            buf.append('\n')
+        if not values:
+            buf.append('\n')
+        buf.append('  </rdf:Description>\n')
+        buf.append(RDF_FOOTER)
+        return ''.join(buf)
+
+    def _get_fragment_tags(self, key):
+        cached = self._fragment_tags.get(key)
+        if cached:
+            return cached
+
+        decls = extract_ns_decls([self._columns[ix].get_property()
+                                  for ix in key])
+        header = RDF_HEADER + render_ns_decls(decls) + '>\n'
+        tags = {}
+        for ix in key:
+            tags[ix] = self._make_tag(ix, decls)
+        cached = (header, tags)
+        if len(self._fragment_tags) < 1024:
+            self._fragment_tags[key] = cached
+        return cached
+
+    def _make_tags(self, decls):
+        return [self._make_tag(ix, decls) for ix in range(len(self._props))]
+
+    def _make_tag(self, ix, decls):
+        "Returns the (start, end) markup for the column with these decls."
+        (col, ns, local) = self._props[ix]
+        tag = "%s:%s" % (decls[ns], local)
+        if col.is_literal():
+            return ("    <%s>" % tag, "</%s>" % tag)
+        else:
+            return ("    <%s rdf:resource='" % tag, "'/>")
         
+NT_SPECIAL_CHARS = re.compile(ur'[\\"\n\r\t]|[^\x20-\x7e]')
+NT_ESCAPES = {u'\\' : '\\\\', u'"' : '\\"', u'\n' : '\\n', u'\r' : '\\r',
+              u'\t' : '\\t'}
+
+def escape_nt(value):
+    """Escapes a string for use in N-Triples, which is ASCII only. Byte
+    strings are assumed to be UTF-8."""
+    if NT_SPECIAL_CHARS.search(value) is None:
+        return value
+    if isinstance(value, str):
+        value = value.decode("utf-8")
+    return str(NT_SPECIAL_CHARS.sub(escape_nt_char, value))
+
+def escape_nt_char(match):
+    ch = match.group()
+    if ch in NT_ESCAPES:
+        return NT_ESCAPES[ch]
+    elif ord(ch) < 0x10000:
+        return "\\u%04X" % ord(ch)
+    return "\\U%08X" % ord(ch)
+
+class NTriplesSerializer:
+    """Renders rows as N-Triples, with the markup for each column worked
+    out once, up front, as in RDFXMLSerializer."""
+
+    def __init__(self, type, columns):
+        self._type_triple = (" <http://www.w3.org/1999/02/22-rdf-syntax-ns#type>"
+                             " <%s> .\n" % escape_nt(type))
+        self._props = []
+        for col in columns:
+            prop = " <%s> " % escape_nt(col.get_property())
+            if col.is_literal():
+                self._props.append((col, prop + '"', '" .\n'))
+            else:
+                self._props.append((col, prop + '<', '> .\n'))
+
+    def render_snapshot(self, rows, pattern):
+        "Yields the triples for the rows, one chunk per BATCH_SIZE rows."
+        return self.render_body(rows, pattern)
+
+    def render_header(self, decls):
+        return ""
+
+    def render_footer(self):
+        return ""
+
+    def render_body(self, rows, pattern, decls = None):
+        buf = []
+        count = 0
+        for obj in rows:
+            self._render(pattern % obj, obj, buf)
+            count += 1
+            if count == BATCH_SIZE:
+                yield ''.join(buf)
+                del buf[ : ]
+                count = 0
+        if buf:
+            yield ''.join(buf)
+
+    def render_fragment(self, uri, obj):
+        buf = []
+        self._render(uri, obj, buf)
+        return ''.join(buf)
+
+    def _render(self, uri, obj, buf):
+        subject = "<%s>" % escape_nt(uri)
+        buf.append(subject)
+        buf.append(self._type_triple)
+        for (col, start, end) in self._props:
+            value = col.get_value(obj)
+            if value:
+                buf.append(subject)
+                buf.append(start)
+                buf.append(escape_nt(value))
+                buf.append(end)
+
+RDFXML = "application/rdf+xml"
+NTRIPLES = "application/n-triples"
+SERIALIZERS = {RDFXML : RDFXMLSerializer,
+               NTRIPLES : NTriplesSerializer,
+               "text/plain" : NTriplesSerializer}
+
 class Column:
  
     def __init__(self, name, prop, literal = True, uripattern = None):
@@ -308,6 +1156,9 @@ class Column:
                 self._prop = prop
                 self._literal = literal
                 self._uripattern = uripattern
+
+    def get_name(self):
+        return self._name
  
     def get_property(self):
         return self._prop
@@ -323,11 +1174,18 @@ class Column:
     def is_literal(self):
         return self._literal
 
+    def to_utf8(self):
+        "Returns a copy of the column with its names and URIs in UTF-8."
+        return Column(to_utf8(self._name), to_utf8(self._prop),
+                      self._literal, to_utf8(self._uripattern))
+
 class CSVFragment(Fragment):
+    "A view on a row tuple in a CSVFragmentFeed."
+    __slots__ = ('_row', )
 
-    def __init__(self, id, updated, feed, obj):
-        Fragment.__init__(self, id, updated, feed)
-        self._obj = obj
+    def __init__(self, feed, row):
+        Fragment.__init__(self, row[1], row[0], feed)
+        self._row = row
 
     def get_title(self):
         return "No title" # at least not yet
@@ -336,14 +1194,11 @@ class CSVFragment(Fragment):
         return self._id
 
     def get_values(self):
-        return self._obj
+        return self._feed.get_values(self._row)
  
-    def render(self):
-        resource = Resource(self.get_uri(), self._feed.get_type())
-        self._feed._add_properties(resource, self)
-        decls = resource.get_ns_decls()
-        return (RDF_HEADER + render_ns_decls(decls) + '>\n' +
-                resource.render(decls) + RDF_FOOTER)
+    def render(self, syntax = None):
+        serializer = self._feed.get_serializer(syntax)
+        return serializer.render_fragment(self.get_uri(), self.get_values())
 
 class Resource:
  
@@ -390,45 +1245,673 @@ except ImportError:
     # don't need to, so let's deal with that later.
     pass
 
-class SQLFragmentFeed:
+POOL_SIZE = 5
+
+class ConnectionPool:
+    """A simple pool of DB-API connections. Connections are opened on
+    demand, and up to POOL_SIZE idle ones are kept around for reuse.
+    module is the DB-API module, and connargs the keyword arguments
+    for its connect() function."""
+
+    def __init__(self, module, connargs, size = POOL_SIZE):
+        self._module = module
+        self._connargs = dict(connargs)
+        if module.__name__ == 'sqlite3':
+            # connections are handed around between request threads
+            self._connargs.setdefault('check_same_thread', False)
+        self._idle = Queue.Queue(size)
+
+    def get(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            return self._module.connect(**self._connargs)
+
+    def put(self, conn):
+        conn.rollback() # we only read, but don't keep transactions open
+        try:
+            self._idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def placeholders(self, count):
+        "Returns count parameter placeholders in the module's paramstyle."
+        style = self._module.paramstyle
+        if style == "qmark":
+            return ["?"] * count
+        elif style == "numeric":
+            return [":%s" % (ix + 1) for ix in range(count)]
+        elif style in ("format", "pyformat"):
+            return ["%s"] * count
+        raise ValueError("Unsupported paramstyle: %s" % style)
+
+    def streaming_cursor(self, conn, name):
+        """Returns a cursor that keeps the result set on the server and
+        fetches it BATCH_SIZE rows at a time, if the driver supports
+        that. Other drivers get an ordinary cursor."""
+        if self._module.__name__.startswith('psycopg2'):
+            cursor = conn.cursor(name)
+            cursor.itersize = BATCH_SIZE
+            return cursor
+        return conn.cursor()
+
+class SQLFragmentFeed(FragmentFeed):
+    """Serves fragments from a table, with the fragments feed paging
+    on (timecol, idcol), which should be indexed. Fragment ids are
+    the values of idcol. The SQL for each kind of query is built once
+    so that drivers which cache prepared statements per connection
+    will reuse them. timestamps says how to interpret the values of
+    timecol, and is also used to turn timestamps back into query
+    parameters."""
  
-    def __init__(self, uripattern, idcol, timecol, table, type, builder, filter = None):
+    def __init__(self, uripattern, idcol, timecol, table, type, pool,
+                 filter = None, timestamps = None):
         self._uripattern = uripattern
-        self._idcol = idcol # FIXME: to be removed, but not right now
+        self._idcol = idcol
         self._timecol = timecol
         self._table = table
         self._type = type
         self._columns = []
-        self._builder = builder
+        self._pool = pool
         self._filter = filter
+        self._timestamps = timestamps or TimestampParser()
+        self._queries = None
+        self._last_changed = (None, 0) # (timestamp, time to ask again)
 
-    def get_fragments(self, since):
-        "since is a string."
-        pass # returns a FragmentPage object
+    def get_fragments(self, since, after = None, strict = False):
+        queries = self._get_queries()
+        if since:
+            if not self._timestamps.knows_source():
+                self.get_last_changed() # see what the values look like
+            since = self._timestamps.to_source(since)
+        if not since:
+            (query, params) = (queries["first"], ())
+        elif strict:
+            (query, params) = (queries["later"], (since, ))
+        elif after is None:
+            (query, params) = (queries["since"], (since, ))
+        else:
+            (query, params) = (queries["after"], (since, since, after))
+
+        rows = self._query(query, params)
+        return FragmentPage([self._make_fragment(row) for row in rows])
  
     def get_fragment_by_id(self, id):
-        pass # returns a Fragment object
+        rows = self._query(self._get_queries()["byid"], (id, ))
+        if not rows:
+            raise KeyError(id)
+        return self._make_fragment(rows[0])
  
-    def snapshot(self):
-        pass # returns the actual snapshot in RDF/XML format
+    def get_snapshot_rows(self):
+        """Streams the rows of the table from the database BATCH_SIZE
+        rows at a time."""
+        return (self._stream_rows(), self._uripattern)
+
+    def get_last_changed(self, load = True):
+        """Runs the max(timecol) query at most once every
+        LAST_CHANGED_TTL seconds, since every feed poll asks."""
+        (updated, expires) = self._last_changed
+        if time.time() < expires:
+            return updated
+
+        rows = self._query(self._get_queries()["latest"], ())
+        updated = None
+        if rows[0][0] is not None:
+            updated = self._timestamps.parse(rows[0][0])
+        self._last_changed = (updated, time.time() + LAST_CHANGED_TTL)
+        return updated
+
+    def make_uri(self, obj):
+        return self._uripattern % obj
+
+    def _stream_rows(self):
+        names = self._get_names()
+        conn = self._pool.get()
+        try:
+            cursor = self._pool.streaming_cursor(conn, "sdshare_snapshot")
+            cursor.execute(self._get_queries()["all"])
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield make_row_dict(names, row)
+            cursor.close()
+        finally:
+            self._pool.put(conn)
+
+    def _query(self, query, params):
+        conn = self._pool.get()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+        finally:
+            self._pool.put(conn)
+
+    def _make_fragment(self, row):
+        obj = make_row_dict(self._get_names(), row)
+        updated = self._timestamps.parse(row[1])
+        return SQLFragment(row[0], updated, self, obj)
+
+    def _get_names(self):
+        return ([self._idcol, self._timecol] +
+                [col.get_name() for col in self._columns])
+
+    def _get_queries(self):
+        if self._queries:
+            return self._queries
+
+        select = "select %s from %s" % (", ".join(self._get_names()),
+                                        self._table)
+        order = " order by %s, %s limit %s" % (self._timecol, self._idcol,
+                                               PAGE_SIZE + 1)
+        conds = []
+        if self._filter:
+            conds.append("(%s)" % self._filter)
+
+        def where(*extra):
+            clauses = conds + list(extra)
+            if not clauses:
+                return ""
+            return " where " + " and ".join(clauses)
+
+        # rows without a timestamp can't be fragments, but they are
+        # still in the snapshot
+        dated = "%s is not null" % self._timecol
+        (p1, p2, p3) = self._pool.placeholders(3)
+        self._queries = {
+            "first" : select + where(dated) + order,
+            "since" : select + where(dated, "%s >= %s" % (self._timecol, p1))
+                      + order,
+            "later" : select + where(dated, "%s > %s" % (self._timecol, p1))
+                      + order,
+            "after" : select + where(dated,
+                                     "(%s > %s or (%s = %s and %s > %s))" %
+                                     (self._timecol, p1, self._timecol, p2,
+                                      self._idcol, p3)) + order,
+            "byid" : select + where(dated, "%s = %s" % (self._idcol, p1)),
+            "all" : select + where(),
+            "latest" : ("select max(%s) from %s" % (self._timecol, self._table)
+                        + where()),
+            }
+        return self._queries
+
+def make_row_dict(names, row):
+    "Turns a database row into a dict like the ones the CSV backend makes."
+    obj = {}
+    for ix in range(len(names)):
+        value = row[ix]
+        if value is None:
+            continue
+        if not isinstance(value, basestring):
+            value = unicode(value)
+        value = value.strip()
+        if value:
+            obj[names[ix]] = value
+    return obj
+
+class SQLFragment(Fragment):
+    __slots__ = ('_obj', )
+
+    def __init__(self, id, updated, feed, obj):
+        Fragment.__init__(self, unicode(id), updated, feed)
+        self._obj = obj
+
+    def get_title(self):
+        return "No title"
+
+    def get_uri(self):
+        return self._feed.make_uri(self._obj)
+
+    def get_values(self):
+        return self._obj
+
+    def render(self, syntax = None):
+        serializer = self._feed.get_serializer(syntax)
+        return serializer.render_fragment(self.get_uri(), self.get_values())
     
+# --- SNAPSHOT FILES
+
+class SnapshotStore:
+    """Keeps the RDF/XML snapshot of each collection in a file, plus a
+    gzipped copy if compress is true. Files are written under a
+    temporary name and renamed into place, so that readers only ever
+    see complete snapshots. The modification time of each file is set
+    to the last change in the data it was made from."""
+
+    def __init__(self, dir, compress = False):
+        self._dir = dir
+        self._compress = compress
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    def get_filename(self, collid, compressed = False):
+        filename = os.path.join(self._dir, urllib.quote(collid, "") + ".rdf")
+        if compressed:
+            filename += ".gz"
+        return filename
+
+    def get_info(self, collid):
+        "Returns (updated, size) of the snapshot file, or None."
+        try:
+            stat = os.stat(self.get_filename(collid))
+        except OSError:
+            return None
+        return (int(round(stat.st_mtime * 1000000)), stat.st_size)
+
+    def is_current(self, coll):
+        "True if the snapshot file is up to date with the collection."
+        updated = coll.get_last_changed()
+        info = self.get_info(coll.get_id())
+        if info is None:
+            return False
+        # allow for file systems with millisecond resolution
+        return updated is None or abs(updated - info[0]) < 1000
+
+    def materialize(self, coll):
+        """Writes a new snapshot of the collection, then swaps it in.
+        Clients already reading the old file keep reading it."""
+        mtime = (coll.get_last_changed() or now_epoch()) / 1000000.0
+
+        filenames = [self.get_filename(coll.get_id())]
+        if self._compress:
+            filenames.append(self.get_filename(coll.get_id(), True))
+        files = [open(filename + ".tmp", "wb") for filename in filenames]
+        try:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            for chunk in coll.snapshot(RDFXML):
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode("utf-8")
+                files[0].write(chunk)
+                if self._compress:
+                    files[1].write(compressor.compress(chunk))
+            if self._compress:
+                files[1].write(compressor.flush())
+
+            for outf in files:
+                outf.flush()
+                os.fsync(outf.fileno())
+        finally:
+            for outf in files:
+                outf.close()
+
+        for filename in filenames:
+            os.utime(filename + ".tmp", (mtime, mtime))
+            os.rename(filename + ".tmp", filename)
+        log.info("wrote snapshot collection=%s bytes=%s",
+                 coll.get_id(), os.path.getsize(filenames[0]))
+
+    def refresh(self, server):
+        """Materializes the snapshots that are out of date. Does nothing
+        if another process is already doing it."""
+        lockf = open(os.path.join(self._dir, ".lock"), "w")
+        try:
+            try:
+                fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            for coll in server.get_collections():
+                if not self.is_current(coll):
+                    self.materialize(coll)
+        finally:
+            lockf.close() # releases the lock
+
+    def serve(self, collid, gzip, environ, start_response):
+        """Serves the snapshot file as a WSGI response, or returns None if
+        there isn't one. Single byte ranges are supported, so that broken
+        downloads can be resumed."""
+        compressed = gzip and self._compress
+        try:
+            inf = open(self.get_filename(collid, compressed), "rb")
+        except IOError:
+            return None
+        stat = os.fstat(inf.fileno())
+        size = stat.st_size
+        etag = '"%s"' % make_etag((collid, compressed, stat.st_mtime, size))
+        modified = datetime.datetime.utcfromtimestamp(int(stat.st_mtime))
+
+        headers = [("Content-Type", RDFXML + "; charset=utf-8"),
+                   ("Vary", "Accept, Accept-Encoding"),
+                   ("Accept-Ranges", "bytes"),
+                   ("Last-Modified", web.httpdate(modified)),
+                   ("ETag", etag)]
+        if compressed:
+            headers.append(("Content-Encoding", "gzip"))
+
+        if is_not_modified(environ, etag, modified):
+            inf.close()
+            start_response("304 Not Modified", headers)
+            return []
+
+        range = None
+        if environ.get("HTTP_IF_RANGE", etag) == etag:
+            try:
+                range = parse_range(environ.get("HTTP_RANGE"), size)
+            except ValueError:
+                inf.close()
+                start_response("416 Requested Range Not Satisfiable",
+                               headers + [("Content-Range",
+                                           "bytes */%s" % size),
+                                          ("Content-Length", "0")])
+                return []
+
+        if range:
+            (start, end) = range
+            status = "206 Partial Content"
+            headers.append(("Content-Range",
+                            "bytes %s-%s/%s" % (start, end - 1, size)))
+        else:
+            (start, end) = (0, size)
+            status = "200 OK"
+        headers.append(("Content-Length", str(end - start)))
+        start_response(status, headers)
+
+        if environ["REQUEST_METHOD"] == "HEAD":
+            inf.close()
+            return []
+        metrics.inc("sdshare_snapshot_bytes_total", end - start,
+                    source = "file")
+        inf.seek(start)
+        if end == size and "wsgi.file_wrapper" in environ:
+            # lets the server use sendfile()
+            return environ["wsgi.file_wrapper"](inf, 65536)
+        return read_blocks(inf, end - start)
+
+def parse_range(header, size):
+    """Parses a Range header into (start, end), with end exclusive.
+    Returns None if the whole file should be served, and raises
+    ValueError if the range can't be satisfied."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None # multiple ranges aren't worth the trouble
+    try:
+        (first, last) = header[6 : ].strip().split("-", 1)
+        if not first:
+            (start, end) = (max(size - int(last), 0), size)
+        elif not last:
+            (start, end) = (int(first), size)
+        else:
+            (start, end) = (int(first), min(int(last) + 1, size))
+    except ValueError:
+        return None # syntactically invalid, so ignored
+    if start >= end:
+        raise ValueError("unsatisfiable range %r" % header)
+    return (start, end)
+
+def is_not_modified(environ, etag, modified):
+    "Implements If-None-Match and If-Modified-Since."
+    if "HTTP_IF_NONE_MATCH" in environ:
+        tags = [tag.strip() for tag in environ["HTTP_IF_NONE_MATCH"].split(",")]
+        return etag in tags or "*" in tags
+    since = web.parsehttpdate(environ.get("HTTP_IF_MODIFIED_SINCE", ""))
+    return since is not None and modified <= since
+
+def read_blocks(inf, length, blocksize = 65536):
+    "Yields length bytes from the file, then closes it."
+    try:
+        while length > 0:
+            block = inf.read(min(blocksize, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        inf.close()
+
+def serve_snapshot_files(wsgiapp):
+    """WSGI middleware which serves materialized snapshots straight
+    from disk, passing all other requests on to web.py."""
+    def serve(environ, start_response):
+        store = server.get_snapshot_store()
+        path = environ.get("PATH_INFO", "")
+        if (store and path.startswith("/snapshot/") and
+            environ["REQUEST_METHOD"] in ("GET", "HEAD") and
+            negotiate_syntax(environ.get("HTTP_ACCEPT")) == RDFXML):
+            gzip = "gzip" in parse_accept(environ.get("HTTP_ACCEPT_ENCODING"))
+            response = store.serve(path[len("/snapshot/") : ], gzip,
+                                   environ, start_response)
+            if response is not None:
+                return response
+        return wsgiapp(environ, start_response)
+    return serve
+
+def start_snapshot_thread():
+    """Starts a thread which keeps the snapshot files up to date, if
+    snapshots are materialized. Must not be called before forking."""
+    store = server.get_snapshot_store()
+    if not store:
+        return
+
+    def run():
+        while True:
+            try:
+                store.refresh(server)
+            except Exception:
+                log.exception("writing snapshots failed")
+            time.sleep(SNAPSHOT_CHECK_INTERVAL)
+
+    thread = threading.Thread(target = run)
+    thread.setDaemon(True)
+    thread.start()
+
+def start_warm_up(threads):
+    """Loads all collections in the background, threads at a time,
+    so that no request has to wait for a collection to load, and
+    /ready can report on the progress meanwhile."""
+    thread = threading.Thread(target = server.load, args = (threads, ))
+    thread.setDaemon(True)
+    thread.start()
+
+# --- METRICS
+
+count_requests = request_counter("sdshare")
+
 # --- UTILITIES
 
-def now_timestamp():
-    return format_py(datetime.datetime.now())
-    
-def format_py(time):
-    # 2008-07-17T15:47:17.062211Z
-    return time.strftime("%Y-%m-%dT%H:%M:%SZ")
- 
-def format_atom(time):
+class RenderCache:
+    """A thread-safe LRU cache of rendered strings, evicting the least
+    recently used entries once the total length of the cached strings
+    exceeds maxsize. Hits and misses are counted in the metrics."""
+
+    def __init__(self, name, maxsize):
+        self._name = name
+        self._maxsize = maxsize
+        self._size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value # move to the back
+        finally:
+            self._lock.release()
+
+        if value is None:
+            metrics.inc("sdshare_cache_misses_total", cache = self._name)
+        else:
+            metrics.inc("sdshare_cache_hits_total", cache = self._name)
+        return value
+
+    def put(self, key, value):
+        if len(value) > self._maxsize:
+            return
+
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self._maxsize:
+                (oldkey, old) = self._entries.popitem(last = False)
+                self._size -= len(old)
+        finally:
+            self._lock.release()
+
+fragment_cache = RenderCache("fragment", FRAGMENT_CACHE_SIZE)
+feed_cache = RenderCache("feed", FEED_CACHE_SIZE)
+
+def make_etag(key):
+    return hashlib.sha1(repr(key)).hexdigest()
+
+# --- TIMESTAMPS
+#
+# Timestamps are integer microseconds since the epoch, in UTC. They're
+# parsed once, when the data is read, and formatted only for output.
+
+EPOCH = datetime.datetime(1970, 1, 1)
+TIMESTAMP = re.compile(r'(\d{4})-(\d\d)-(\d\d)[ T](\d\d):(\d\d):(\d\d)'
+                       r'(?:\.(\d{1,6}))?$')
+
+class TimestampParser:
+    """Parses timestamps from a source. format is a strptime format,
+    'epoch' for (possibly fractional) seconds since the epoch, or None
+    for 'YYYY-MM-DD HH:MM:SS[.ffffff]', with a space or a T in the
+    middle. timezone is the time zone of the source: 'UTC' (the
+    default), 'local', or an offset like '+01:00'. Values the database
+    driver has already turned into datetimes or numbers are accepted
+    too.
+
+    The parser remembers what the values it has seen looked like, so
+    that to_source can give back values of the same kind. With no
+    format, string values should all be written the same way (T or
+    space, same number of decimals), since they are compared as
+    strings."""
+
+    def __init__(self, format = None, timezone = None):
+        self._format = format
+        self._offset = parse_offset(timezone) # None means local time
+        self._style = None # 'datetime', 'number', or (separator, decimals)
+
+    def parse(self, value):
+        "Returns the value as a timestamp. Raises ValueError on bad input."
+        if isinstance(value, datetime.datetime):
+            self._style = "datetime"
+            return self._from_source(value)
+        if self._format == "epoch" or isinstance(value, (int, long, float)):
+            self._style = "number"
+            return int(round(float(value) * 1000000))
+
+        value = value.strip()
+        if self._format:
+            return self._from_source(datetime.datetime.strptime(value,
+                                                                self._format))
+        match = TIMESTAMP.match(value)
+        if not match:
+            raise ValueError("Bad timestamp: %r" % value)
+        (year, month, day, hour, minute, second, fraction) = match.groups()
+        self._style = (value[10], len(fraction or ""))
+        return self._from_source(datetime.datetime(
+            int(year), int(month), int(day), int(hour), int(minute),
+            int(second), int((fraction or "0").ljust(6, "0"))))
+
+    def knows_source(self):
+        "True if to_source knows what kind of values the source has."
+        return self._format is not None or self._style is not None
+
+    def to_source(self, timestamp):
+        """Inverse of parse: turns a timestamp into a value that can be
+        compared with the values in the source. Until a value has been
+        parsed, a source with no format is assumed to give datetimes."""
+        if self._format == "epoch" or self._style == "number":
+            if timestamp % 1000000:
+                return timestamp / 1000000.0
+            return timestamp // 1000000
+
+        if self._offset is None:
+            value = datetime.datetime.fromtimestamp(timestamp // 1000000)
+            value = value.replace(microsecond = timestamp % 1000000)
+        else:
+            value = to_datetime(timestamp + self._offset * 1000000)
+        if self._format:
+            return value.strftime(self._format)
+        if isinstance(self._style, tuple):
+            (separator, decimals) = self._style
+            text = value.strftime("%Y-%m-%d" + separator + "%H:%M:%S")
+            if decimals:
+                text += (".%06d" % value.microsecond)[ : decimals + 1]
+            return text
+        return value
+
+    def _from_source(self, value):
+        if value.tzinfo is not None:
+            return to_epoch(value.replace(tzinfo = None) - value.utcoffset())
+        if self._offset is None:
+            return (int(time.mktime(value.timetuple())) * 1000000 +
+                    value.microsecond)
+        return to_epoch(value) - self._offset * 1000000
+
+def parse_offset(timezone):
+    """Parses a time zone setting into seconds east of UTC, or None
+    for local time."""
+    if timezone is None or timezone.strip().upper() in ("UTC", "Z", ""):
+        return 0
+    if timezone.strip().lower() == "local":
+        return None
+    match = re.match(r'([+-])(\d\d):?(\d\d)$', timezone.strip())
+    if not match:
+        raise ValueError("Unsupported time zone: %r" % timezone)
+    (sign, hours, minutes) = match.groups()
+    offset = int(hours) * 3600 + int(minutes) * 60
+    if sign == "-":
+        return -offset
+    return offset
+
+def to_epoch(value):
+    "Turns a naive datetime in UTC into a timestamp."
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def to_datetime(timestamp):
+    "Turns a timestamp into a naive datetime in UTC."
+    return EPOCH + datetime.timedelta(microseconds = timestamp)
+
+def now_epoch():
+    return to_epoch(datetime.datetime.utcnow())
+
+def format_updated(timestamp):
+    "Formats a last changed value, which may be None."
+    if timestamp is None:
+        return format_atom(now_epoch())
+    return format_atom(timestamp)
+
+def latest(times):
+    "Returns the latest of the timestamps, ignoring Nones."
+    times = [t for t in times if t is not None]
+    if not times:
+        return None
+    return max(times)
+
+atom_cache = {} # timestamp -> Atom string
+
+def format_atom(timestamp):
     # 2008-07-17T15:47:17.062211Z
-    return (str(time) + 'Z').replace(' ', 'T')
+    value = atom_cache.get(timestamp)
+    if value is None:
+        if len(atom_cache) >= ATOM_CACHE_SIZE:
+            atom_cache.clear()
+        value = (str(to_datetime(timestamp)) + 'Z').replace(' ', 'T')
+        atom_cache[timestamp] = value
+    return value
  
 def parse_atom(timestr):
-    assert timestr[-1] == 'Z'
-    timestr = timestr[ : -1].replace('T', ' ')
-    return Timestamp.valueOf(timestr)
+    "Inverse of format_atom. Raises ValueError on bad input."
+    if not timestr.endswith('Z'):
+        raise ValueError("Atom timestamp must end in Z: %r" % timestr)
+    return parse_timestamp(timestr[ : -1])
+
+def parse_timestamp(timestr):
+    "Parses 'YYYY-MM-DD HH:MM:SS[.ffffff]' in UTC into a timestamp."
+    return utc_timestamps.parse(timestr)
+
+utc_timestamps = TimestampParser()
 
 # --- CONFIG LOADING
 
@@ -442,10 +1925,10 @@ class ConfigHandler(SAXTracker):
         self._server = Server(None, None)
         self._coll = None
         self._feed = None
+        self._backend = None
         
         self._obj = self._server
         self._attrs = None
-        # FIXME: for now, csv is the only backend type
         
     def startElement(self, name, attrs):
         SAXTracker.startElement(self, name, attrs)
@@ -453,14 +1936,18 @@ class ConfigHandler(SAXTracker):
         if name == "param":
             self._attrs = attrs
 
+        elif name == "backend":
+            self._backend = get_backend(attrs["type"])(attrs)
+
         elif name == "collection":
             self._coll = Collection(attrs["title"], attrs["id"], None,
                                     self._server)
             self._server.add_collection(self._coll)
 
         elif name == "relation":
-            self._feed = CSVFragmentFeed(attrs["source"], attrs["type"],
-                                         attrs["pattern"], attrs["timestamp"])
+            if self._backend is None: # no <backend> element, as in old files
+                self._backend = CSVBackend({})
+            self._feed = self._backend.make_feed(attrs)
             self._coll.add_feed(self._feed)
 
         elif name == "property":
@@ -472,14 +1959,81 @@ class ConfigHandler(SAXTracker):
         if name == "param":
             set_param(self._obj, self._attrs["name"], self._contents)
 
+def make_timestamp_parser(attrs):
+    return TimestampParser(attrs.get("timeformat"), attrs.get("timezone"))
+
+# --- BACKENDS
+
+# A backend is made from the attributes of a <backend> element, and
+# makes a fragment feed from the attributes of each <relation> inside
+# it. Columns are added to the feed afterwards.
+
+class CSVBackend:
+    "Reads CSV files, one per relation."
+
+    def __init__(self, attrs):
+        pass
+
+    def make_feed(self, attrs):
+        return CSVFragmentFeed(attrs["source"], attrs["type"],
+                               attrs["pattern"], attrs["timestamp"],
+                               attrs.get("reload") == "true",
+                               make_timestamp_parser(attrs))
+
+class SQLBackend:
+    """Reads tables through a DB-API module. All attributes other
+    than type and module are arguments to connect()."""
+
+    def __init__(self, attrs):
+        connargs = dict([(str(k), v) for (k, v) in attrs.items()
+                         if k not in ("type", "module")])
+        module = __import__(attrs["module"])
+        self._pool = ConnectionPool(module, connargs)
+
+    def make_feed(self, attrs):
+        return SQLFragmentFeed(attrs["pattern"], attrs["idcolumn"],
+                               attrs["timestamp"], attrs["table"],
+                               attrs["type"], self._pool,
+                               attrs.get("filter"),
+                               make_timestamp_parser(attrs))
+
+BACKENDS = {"csv" : CSVBackend,
+            "sql" : SQLBackend}
+
+def register_backend(type, backend):
+    """Makes <backend type="..."> use the given class, which must be
+    callable with the element's attributes."""
+    BACKENDS[type] = backend
+
+def get_backend(type):
+    """Returns the backend class for the type: a registered one, or
+    else a class given as module.ClassName."""
+    if type in BACKENDS:
+        return BACKENDS[type]
+    if "." in type:
+        (module, name) = type.rsplit(".", 1)
+        return getattr(__import__(module, fromlist = [name]), name)
+    raise ValueError("Unknown backend type %r, must be one of %s" %
+                     (type, ", ".join(sorted(BACKENDS))))
+
 # --- INIT
 
-handler = ConfigHandler()
-p = make_parser()
-p.setContentHandler(handler)
-p.parse("config.xml")
+def load_config(filename):
+    handler = ConfigHandler()
+    p = make_parser()
+    p.setContentHandler(handler)
+    p.parse(filename)
+    return handler._server
 
-server = handler._server
+server = None # set by init()
+
+def init(configfile = None):
+    """Loads the configuration, unless that has already been done. The
+    file name defaults to $SDSHARE_CONFIG, then config.xml."""
+    global server
+    if server is None:
+        server = load_config(configfile or
+                             os.environ.get("SDSHARE_CONFIG", "config.xml"))
 
 # --- STARTUP
 
@@ -487,8 +2041,82 @@ web.config.debug = True
 web.webapi.internalerror = web.debugerror
  
 appdir = os.path.dirname(__file__)
-render = web.template.render(os.path.join(appdir, 'templates/'))
+render = web.template.render(os.path.join(appdir, 'templates/'),
+                             globals = {"format_atom" : format_atom})
 app = web.application(urls, globals(), autoreload = False)
+wsgiapp = count_requests(serve_snapshot_files(app.wsgifunc()))
+started = threading.Lock()
+
+def application(environ, start_response):
+    """WSGI entry point. The configuration is loaded on the first
+    request, so that importing this module doesn't do any work. If
+    $SDSHARE_WARM_THREADS is set the collections are loaded then, too."""
+    init()
+    if started.acquire(False): # never released, so this runs once
+        start_snapshot_thread()
+        if os.environ.get("SDSHARE_WARM_THREADS"):
+            start_warm_up(int(os.environ["SDSHARE_WARM_THREADS"]))
+    return wsgiapp(environ, start_response)
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+def serve_forked(port, workers, threads = 1):
+    """Loads all the data, threads collections at a time, then forks
+    worker processes which accept connections on the same socket. The
+    workers share the loaded data copy-on-write, and each one handles
+    requests in separate threads, so that long snapshot downloads
+    don't hold up other clients."""
+    server.load(threads)
+    httpd = ThreadingWSGIServer(('', port), WSGIRequestHandler)
+    httpd.set_app(wsgiapp)
+    log.info("listening port=%s workers=%s", port, workers)
+
+    children = []
+    for ix in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                httpd.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    start_snapshot_thread() # only in the parent, now that it has forked
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
  
 if __name__ == "__main__":
-    app.run()
+    parser = OptionParser(usage = "%prog [options] [port]")
+    parser.add_option("-c", "--config", dest = "config", default = "config.xml",
+                      help = "configuration file")
+    parser.add_option("-w", "--workers", dest = "workers", type = "int",
+                      help = "load all data, then fork this many workers")
+    parser.add_option("--warm", dest = "warm", type = "int",
+                      help = "load this many collections at a time on "
+                             "startup, instead of on the first request")
+    parser.add_option("-l", "--log-level", dest = "loglevel",
+                      default = os.environ.get("SDSHARE_LOG_LEVEL", "info"),
+                      help = "debug, info, warning or error (default %default)")
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level = getattr(logging, options.loglevel.upper()),
+                        format = LOG_FORMAT)
+    init(options.config)
+
+    if options.workers:
+        port = 8080
+        if args:
+            port = int(args[0])
+        serve_forked(port, options.workers, options.warm or 1)
+    else:
+        sys.argv[1 : ] = args # web.py reads the port from here
+        start_snapshot_thread()
+        if options.warm:
+            start_warm_up(options.warm)
+        app.run(serve_snapshot_files, count_requests)
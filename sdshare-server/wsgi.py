@@ -0,0 +1,18 @@
+"""
+WSGI entry point for sdshare-server, for use with servers like
+gunicorn or mod_wsgi:
+
+    gunicorn -w 4 wsgi:application
+
+The configuration is read from $SDSHARE_CONFIG, or config.xml in the
+current directory, when the first request comes in.
+"""
+
+import os, sys, imp
+
+appdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, appdir)
+sdshare_server = imp.load_source('sdshare_server',
+                                 os.path.join(appdir, 'sdshare-server.py'))
+
+application = sdshare_server.application
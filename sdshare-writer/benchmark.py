@@ -0,0 +1,247 @@
+"""
+Benchmarks for sdshare-writer. Run with
+
+    python benchmark.py [options] [resources]
+
+or with Jython, with the JDBC driver on the classpath, to use --jdbc.
+
+This generates N-Triples for the given number of resources (default
+100,000), or reads them from a file given with --ntriples (for example
+one written by sdshare-server's benchmark.py), and measures how fast
+they are parsed (also by Duke's Java parser, if it is on the
+classpath) and turned into SQL statements, and how fast delta updates
+skip unchanged resources and find changed columns. Given a JDBC URL it
+also writes them to the database, first as inserts and then as
+updates. With --upsert both rounds are native upserts instead, which
+can be tried out on SQLite with --jdbc jdbc:sqlite:test.db --create
+--upsert sqlite. Use --json to save the results, and --compare to see
+how they differ from results saved earlier.
+"""
+
+import os, sys, time, imp, tempfile, platform
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+appdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, appdir)
+sdw = imp.load_source('sdshare_writer',
+                      os.path.join(appdir, 'sdshare-writer.py'))
+
+TYPE = "http://example.org/ont/Customer"
+PATTERN = "http://example.org/data/customer/%s"
+PROPERTY = "http://example.org/ont/col%s"
+PKEY = "customer_id"
+
+def generate_ntriples(filename, resources, columns):
+    "Writes N-Triples for resources with the given number of properties."
+    outf = open(filename, 'wb')
+    for ix in xrange(resources):
+        subject = "<%s>" % (PATTERN % ix)
+        outf.write("%s <%s> <%s> .\n" % (subject, sdw.TYPE_FIELD, TYPE))
+        for col in range(columns):
+            outf.write('%s <%s> "value %s of resource %s" .\n' %
+                       (subject, PROPERTY % col, col, ix))
+    outf.close()
+
+def read_objects(filename):
+    "Parses the file, returning the resources as dicts."
+    objects = []
+    inf = open(filename, 'rb')
+    grouper = sdw.SubjectGrouper(objects.append)
+    sdw.parse_ntriples(inf, grouper)
+    grouper.flush()
+    inf.close()
+    return objects
+
+def read_objects_duke(filename):
+    "Parses the file with Duke's NTriplesParser instead."
+    from java.io import FileReader
+    from no.priv.garshol.duke import StatementHandler
+    from no.priv.garshol.duke.utils import NTriplesParser
+
+    class Handler(StatementHandler):
+        def __init__(self, grouper):
+            self.statement = grouper.statement
+
+    objects = []
+    reader = FileReader(filename)
+    grouper = sdw.SubjectGrouper(objects.append)
+    NTriplesParser.parse(reader, Handler(grouper))
+    grouper.flush()
+    reader.close()
+    return objects
+
+class Results:
+    "Collects the measurements, printing each one as it comes in."
+
+    def __init__(self, resources, triples):
+        self.resources = resources
+        self.triples = triples
+        self.measurements = {}
+
+    def report(self, name, count, unit, secs):
+        print "%-10s %10d %-10s %8.1f s %10.0f %s/s" % \
+              (name, count, unit, secs, count / secs, unit)
+        self.measurements[name] = {"%s_per_sec" % unit : count / secs}
+
+    def to_json(self):
+        return {"time" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python" : platform.python_version(),
+                "resources" : self.resources,
+                "triples" : self.triples,
+                "results" : self.measurements}
+
+def timed(function, *args):
+    "Returns (result, seconds)."
+    start = time.time()
+    result = function(*args)
+    return (result, time.time() - start)
+
+def generate_all(objects):
+    return [sdw.generate_sql(object) for object in objects]
+
+def record_digests(objects):
+    "Records the digests as if the statements had been committed."
+    ids = []
+    for (object, statement) in zip(objects, generate_all(objects)):
+        sdw.content_hashes.stage(object[sdw.ID_FIELD], statement[2])
+        ids.append(object[sdw.ID_FIELD])
+    sdw.content_hashes.commit(ids)
+
+def write_all(objects):
+    for object in objects:
+        sdw.write_object(object)
+    sdw.writer.commit()
+
+def create_table(conn, object):
+    """Creates a table the objects can be written to. In upsert mode
+    it has a unique natural key column, and the database makes the
+    primary keys."""
+    table = sdw.find_table_name(object)
+    columns = ["%s varchar(100)" % field for (field, value)
+               in sdw.make_field_values(object, 0, False)]
+    if sdw.UPSERT_DIALECT:
+        columns.append("%s varchar(200) unique" % sdw.NATURAL_KEY_FIELD)
+    stmt = conn.createStatement()
+    stmt.execute("create table %s (%s integer primary key, %s)" %
+                 (table, PKEY, ", ".join(columns)))
+    stmt.close()
+    conn.commit()
+
+def compare(results, filename):
+    "Prints the change in each measurement since the results in the file."
+    old = json.load(open(filename))
+    print
+    print "Compared to %s (%s resources, %s):" % \
+          (filename, old["resources"], old["time"])
+    for (name, values) in sorted(results.measurements.items()):
+        for (key, value) in sorted(values.items()):
+            before = old["results"].get(name, {}).get(key)
+            if before:
+                print "  %-28s %12.1f -> %12.1f %+7.1f%%" % \
+                      ("%s.%s" % (name, key), before, value,
+                       (value - before) * 100.0 / before)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage = "%prog [options] [resources]")
+    parser.add_option("-c", "--columns", dest = "columns", type = "int",
+                      default = 5, help = "properties per resource "
+                                          "(default %default)")
+    parser.add_option("--ntriples", dest = "ntriples",
+                      help = "read the data from this file instead")
+    parser.add_option("--jdbc", dest = "jdbc",
+                      help = "JDBC URL of a database to write to")
+    parser.add_option("--driver", dest = "driver",
+                      help = "JDBC driver class")
+    parser.add_option("--user", dest = "user", default = "")
+    parser.add_option("--password", dest = "password", default = "")
+    parser.add_option("--create", dest = "create", action = "store_true",
+                      help = "create the table before writing")
+    parser.add_option("--upsert", dest = "upsert",
+                      help = "write upserts in this dialect: sqlite, "
+                             "postgresql, mysql or oracle")
+    parser.add_option("--json", dest = "json",
+                      help = "save the results as JSON in this file")
+    parser.add_option("--compare", dest = "compare",
+                      help = "compare with results saved by --json")
+    (options, args) = parser.parse_args()
+    resources = 100000
+    if args:
+        resources = int(args[0])
+
+    tmpdir = tempfile.mkdtemp()
+    sdw.pkeyman = sdw.PrimaryKeyManager(os.path.join(tmpdir, "pkeys.log"))
+    sdw.pkey_fields[TYPE] = PKEY
+    sdw.UPSERT_DIALECT = options.upsert
+    rounds = ("insert", "update")
+    if options.upsert:
+        rounds = ("upsert", "upsert-2")
+    filename = options.ntriples
+    try:
+        if not filename:
+            filename = os.path.join(tmpdir, "data.nt")
+            print "Generating %s resources with %s properties..." % \
+                  (resources, options.columns)
+            generate_ntriples(filename, resources, options.columns)
+
+        (objects, secs) = timed(read_objects, filename)
+        triples = sum([len(object) - 1 for object in objects])
+        results = Results(len(objects), triples)
+        results.report("parse", triples, "triples", secs)
+        try:
+            (duke, secs) = timed(read_objects_duke, filename)
+            results.report("parse-duke", triples, "triples", secs)
+        except ImportError:
+            pass # not Jython, or no Duke
+
+        # inserts the first time, then updates, since the keys are known
+        for name in rounds:
+            (statements, secs) = timed(generate_all, objects)
+            results.report(name, len(statements), "statements", secs)
+
+        # the same with delta updates, once the digests are known: first
+        # with nothing changed, then with one property changed
+        sdw.content_hashes = sdw.ContentHashes(os.path.join(tmpdir,
+                                                            "hashes.log"))
+        record_digests(objects)
+        (statements, secs) = timed(generate_all, objects)
+        results.report("unchanged", len(objects), "resources", secs)
+        for object in objects:
+            object[PROPERTY % 0] += " changed"
+        (statements, secs) = timed(generate_all, objects)
+        results.report("delta", len(objects), "resources", secs)
+        sdw.content_hashes.close()
+        sdw.content_hashes = None
+
+        if options.jdbc:
+            # start over, so that the first round is inserts again
+            sdw.pkeyman.close()
+            sdw.pkeyman = sdw.PrimaryKeyManager(os.path.join(tmpdir,
+                                                             "written.log"))
+            conn = sdw.connect(options.jdbc, options.user, options.password,
+                               options.driver)
+            if options.create:
+                create_table(conn, objects[0])
+            sdw.writer = sdw.BatchWriter(conn, sdw.BATCH_SIZE,
+                                         sdw.COMMIT_INTERVAL)
+            for name in ["jdbc-" + name for name in rounds]:
+                (result, secs) = timed(write_all, objects)
+                results.report(name, len(objects), "statements", secs)
+            sdw.writer.close()
+            conn.close()
+    finally:
+        sdw.pkeyman.close()
+        for name in os.listdir(tmpdir):
+            os.unlink(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+    if options.json:
+        outf = open(options.json, 'w')
+        json.dump(results.to_json(), outf, indent = 2, sort_keys = True)
+        outf.close()
+    if options.compare:
+        compare(results, options.compare)
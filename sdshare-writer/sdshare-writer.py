@@ -1,258 +1,1392 @@
-# implements a simple "POST rdf here" service.  this means we need a
-# separate backend in the SDshare client.
-# http://www.w3.org/TR/sparql11-http-rdf-update/
-
-import sys, anydbm
-import web
-
-from java.io import FileReader
-from no.priv.garshol.duke.utils import NTriplesParser
-
-urls = (
-    '/', 'HandleData',
-    )
-
-# clear:
-#   wipe id-to-key store
-#   truncate table
-
-class HandleData:
-
-    def POST(self):
-        subject = web.input().get("resource")
-        data = web.input().get("data")
-        print repr(data)
-        object = parse_data(data)
-        print object
-        sql = generate_sql(object)
-        write_to_db(sql)
-        conn.commit()
-        pkeyman.commit()
-
-        web.header("Content-Type","text/plain")
-        return "OK"
-
-# ---------------------------------------------------------------------------
-
-ID_FIELD = "__ID__"
-TYPE_FIELD = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
-PKEY_FIELD = "http://psi.nav.no/2012/mod/meta/pkey-field"
-
-def generate_sql(object):
-    id = object[ID_FIELD]
-    pkey = pkeyman.find_pkey_for(id)
-    if not pkey:
-        return generate_insert(object)
-    else:
-        return generate_update(object, pkey)
-
-def generate_insert(object):
-    pkey = pkeyman.generate_pkey(object)
-    table = find_table_name(object)
-
-    values = make_field_values(object, pkey)
-
-    return "insert into %s (%s) values (%s)" % \
-        (table,
-         commalist([field for (field, value) in values]),
-         commalist([sql(value) for (field, value) in values]))
-
-def generate_update(object, pkey):
-    table = find_table_name(object)
-    values = make_field_values(object, pkey, False)
-
-    pkey_field = find_pkey_field(object)
-    return ("update %s set %s where %s = %s" %
-            (table,
-             commalist(["%s = %s" % (to_name(f), sql(v)) for (f, v) in values]),
-             pkey_field, sql(pkey)))
-
-def find_table_name(object):
-    return to_name(object[TYPE_FIELD])
-
-def to_name(uri):
-    pos = uri.rfind('/')
-    return uri[pos + 1 : ]
-
-#def find_pkey_field(object):
-#    return object[PKEY_FIELD]
-def find_pkey_field(object):
-    type = object[TYPE_FIELD]
-    return pkey_fields[type]
-
-# this makes a first, literal translation of the RDF, ignoring the
-# configuration
-
-def literal_translation(object, id = None, include_id = True):
-    values = [(to_name(f), v) for (f, v) in object.items()
-              if f not in (TYPE_FIELD, ID_FIELD, PKEY_FIELD)]
-
-    if include_id:
-        pkey_field = find_pkey_field(object)
-        values.append((pkey_field, id))
-
-    newobject = {}
-    for (f, v) in values:
-        newobject[f] = v
-    return newobject
-
-# takes the literally translated object and applies the configuration to
-# produce the final version
-
-def make_field_values(object, id = None, include_id = True):
-    object = literal_translation(object, id, include_id)
-    print "newobject:", object
-    for (f, pattern) in compound_fields:
-        value = pattern % ObjectWrapper(object)
-        if value.strip():
-            object[f] = value.strip()
-
-    for f in skip_fields:
-        try:
-            del object[f]
-        except KeyError:
-            pass # if we don't have the field, no problem
-
-    return object.items()
-
-def commalist(list):
-    return ", ".join(list)
-
-def sql(value):
-    if type(value) == int:
-        return str(value)
-    else:
-        return "'" + value + "'"
-
-def remap(v, fromv, tov):
-    if v == fromv:
-        return tov
-    else:
-        return v
-        
-class ObjectWrapper:
-
-   def __init__(self, object):
-        self._object = object
-        
-   def __getitem__(self, key):
-        return self._object.get(key, "").strip()
-
-# ---------------------------------------------------------------------------
-
-class PrimaryKeyManager:
-
-    def __init__(self):
-        self._id_to_pkey = {} #anydbm.open('id-to-pkey.dbm', 'c')
-        self._previd = 0
-
-    def find_pkey_for(self, id):
-        return self._id_to_pkey.get(id)
-
-    def generate_pkey(self, object):
-        id = object[ID_FIELD]
-        self._previd += 1
-        pkey = self._previd
-        self._id_to_pkey[str(id)] = str(pkey)
-        return pkey
-
-    def commit(self):
-        self._id_to_pkey.sync()
-    
-    def close(self):
-        pass #self._id_to_pkey.close()
-
-# ---------------------------------------------------------------------------
-
-from no.priv.garshol.duke import StatementHandler
-
-class DictMapper(StatementHandler):
-
-    def __init__(self):
-        self._dict = {}
-
-    def statement(self, subj, prop, obj, lit):
-        self._dict[ID_FIELD] = subj
-        self._dict[prop] = obj
-
-    def get_dict(self):
-        return self._dict
-
-def parse_data(rdf_string):
-    from java.io import StringReader
-
-    mapper = DictMapper()
-    NTriplesParser.parse(StringReader(rdf_string), mapper)
-    return mapper.get_dict()
-
-# ---------------------------------------------------------------------------
-
-from java.lang import Class
-from java.sql import DriverManager
-
-DRIVERCLASS = "oracle.jdbc.driver.OracleDriver"
-JDBCURL = "jdbc:oracle:thin:@d26dbbl002.test.local:1521:mod01"
-USER = "mod"
-PASSWORD = "xlesDGn3"
-
-Class.forName(DRIVERCLASS)
-conn = DriverManager.getConnection(JDBCURL, USER, PASSWORD)
-stmt = conn.createStatement()
-
-def write_to_db(sql):
-    stmt.execute(sql)
-
-# def write_to_db(sql):
-#     print sql
-
-# conn.commit()
-# stmt.close()
-# conn.close()
-
-# ---------------------------------------------------------------------------
-
-pkeyman = PrimaryKeyManager()
-
-# object = {
-#     ID_FIELD : "http://ex/adr/342343",
-#     TYPE_FIELD : "http://ex/Adressebruk",
-#     PKEY_FIELD : "adressebruk_id",
-#     "http://ex/adressekode" : "STILL",
-#     "http://ex/landkode" : "NO",
-#     "http://ex/postnr" : "0440",
-#     }
-
-# sql = generate_sql(object)
-# print sql
-# write_to_db(sql)
-
-# mapper = DictMapper()
-# fr = FileReader(sys.argv[1])
-# NTriplesParser.parse(fr, mapper)
-# fr.close()
-
-# sql = generate_sql(mapper.get_dict())
-# print sql
-# #write_to_db(sql)
-
-# ---------------------------------------------------------------------------
-# had to introduce some configuration, unfortunately.
-
-skip_fields = set(["husnr", "gatenavn", "bokstav"])
-compound_fields = [("adrlinje1", "%(gatenavn)s %(husnr)s%(bokstav)s")]
-pkey_fields = {"http://psi.garshol.priv.no/tmp/Adresse" : "adressebruk_id",
-               "http://psi.garshol.priv.no/tmp/Person" : "person_id",
-               "http://example.com/Person" : "person_id",
-               "http://example.com/Adressebruk" : "adressebruk_id"}
-
-# ---------------------------------------------------------------------------
-
-#web.config.debug = False
-web.webapi.internalerror = web.debugerror
-app = web.application(urls, globals())
-#app.internalerror = Error
-
-if __name__ == "__main__":
-    app.run()
-
-pkeyman.close()
+# implements a simple "POST rdf here" service.  this means we need a
+# separate backend in the SDshare client.
+# http://www.w3.org/TR/sparql11-http-rdf-update/
+
+import sys, os, time, threading, logging, collections, itertools
+import re, zlib, hashlib
+import web
+from xml.sax import make_parser
+from xml.sax.handler import ContentHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "sdshare-common"))
+from instrumentation import metrics, profiler, request_counter, \
+     MAX_PROFILE_TIME
+
+urls = (
+    '/', 'HandleData',
+    '/bulk', 'HandleBulk',
+    '/metrics', 'HandleMetrics',
+    '/profile', 'HandleProfile',
+    )
+
+log = logging.getLogger("sdshare-writer")
+
+# clear:
+#   wipe id-to-key store
+#   truncate table
+
+class HandleData:
+
+    def POST(self):
+        subject = web.input().get("resource")
+        data = web.input().get("data")
+        log.debug("received resource=%s data=%r", subject, data)
+        object = parse_data(data)
+        log.debug("parsed object=%r", object)
+        if queue:
+            queue_objects([object])
+        else:
+            write_object(object)
+
+        web.header("Content-Type","text/plain")
+        return "OK"
+
+class HandleBulk:
+    """Takes N-Triples for any number of resources in the request body,
+    and writes each resource. The response has one line per resource,
+    saying what was done with it. A resource is only reported as
+    written once its statement has been committed; if the transaction
+    it was in is rolled back, it is reported as an error."""
+
+    def POST(self):
+        if queue:
+            objects = []
+            grouper = SubjectGrouper(objects.append)
+            parse_ntriples(request_lines(), grouper)
+            grouper.flush()
+            queue_objects(objects)
+            web.header("Content-Type","text/plain")
+            return "".join(["%s queued\n" % object[ID_FIELD]
+                            for object in objects])
+
+        start = time.time()
+        summary = [] # one line per resource, None until we know
+        def write(object):
+            id = object[ID_FIELD]
+            ix = len(summary)
+            summary.append(None)
+            def done(error, kind):
+                if error is None:
+                    summary[ix] = "%s %s\n" % (id, kind)
+                else:
+                    summary[ix] = "%s error: %s\n" % (id, error)
+            try:
+                kind = write_object(object, done)
+                if kind == "unchanged":
+                    done(None, kind)
+            except Exception, e:
+                if summary[ix] is None: # else rolled back with the rest
+                    summary[ix] = "%s error: %s\n" % (id, e)
+
+        grouper = SubjectGrouper(write)
+        parse_ntriples(request_lines(), grouper)
+        grouper.flush()
+        try:
+            writer.commit()
+        except Exception:
+            log.exception("bulk commit failed")
+        log.info("bulk resources=%s secs=%.3f", len(summary),
+                 time.time() - start)
+
+        web.header("Content-Type","text/plain")
+        return "".join(summary)
+
+class HandleMetrics:
+
+    def GET(self):
+        web.header("Content-Type", "text/plain; version=0.0.4")
+        return metrics.render()
+
+class HandleProfile:
+    """Samples the stacks of all threads for the given number of
+    seconds, then returns them in the folded format flamegraph.pl
+    takes. Only available if PROFILING is true."""
+
+    def GET(self):
+        if not PROFILING:
+            raise web.notfound()
+        try:
+            seconds = float(web.input(seconds = "10").seconds)
+        except ValueError:
+            raise web.badrequest()
+        if not profiler.start(min(seconds, MAX_PROFILE_TIME)):
+            raise web.conflict() # someone else is profiling
+        web.header("Content-Type", "text/plain")
+        return profiler.get_folded()
+
+def request_lines():
+    """Iterates over the lines of the request body, reading them as
+    they are needed rather than all at once."""
+    env = web.ctx.env
+    if not env.get("CONTENT_LENGTH"):
+        return web.data().splitlines(True) # chunked, so let web.py read it
+    return read_lines(env["wsgi.input"], int(env["CONTENT_LENGTH"]))
+
+def read_lines(inf, remaining):
+    while remaining > 0:
+        line = inf.readline(remaining)
+        if not line:
+            break
+        remaining -= len(line)
+        yield line
+
+def queue_objects(objects):
+    """Queues the objects and sets the status to 202, or, if the queue
+    is full, refuses all of them with a 503."""
+    if not queue.put(objects):
+        metrics.inc("sdshare_writer_rejected_total", len(objects))
+        raise web.HTTPError("503 Service Unavailable",
+                            {"Content-Type" : "text/plain",
+                             "Retry-After" : str(RETRY_AFTER)},
+                            "queue full\n")
+    web.ctx.status = "202 Accepted"
+
+# ---------------------------------------------------------------------------
+
+ID_FIELD = "__ID__"
+TYPE_FIELD = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+PKEY_FIELD = "http://psi.nav.no/2012/mod/meta/pkey-field"
+
+def write_object(object, done = None):
+    """Writes the object, returning 'insert', 'update', 'upsert' or
+    'unchanged'. Unless the object is unchanged, done is called with
+    (error, kind) once the statement is committed, with None for the
+    error, or rolled back."""
+    statement = generate_sql(object)
+    if statement is None:
+        metrics.inc("sdshare_writer_unchanged_total")
+        return "unchanged"
+    (sql, params, digests, fallback) = (statement + (None, ))[ : 4]
+    kind = statement_kind(sql)
+    listener = None
+    if done is not None:
+        listener = lambda error: done(error, kind)
+    writer.add(object[ID_FIELD], sql, params, digests, fallback, listener)
+    return kind
+
+def generate_sql(object):
+    """Returns (sql, params, digests) or, for updates, (sql, params,
+    digests, fallback), or None if the object hasn't changed."""
+    if UPSERT_DIALECT:
+        return generate_upsert(object)
+
+    id = object[ID_FIELD]
+    pkey = pkeyman.find_pkey_for(id)
+    if not pkey:
+        return generate_insert(object)
+    else:
+        return generate_update(object, pkey)
+
+# the generate_* functions return (sql, params, digests), with ?
+# placeholders in the SQL. the columns are sorted so that objects of the
+# same type with the same fields produce the same SQL, and can be
+# batched together. with content_hashes set, updates and upserts return
+# None if nothing has changed, and updates only set the columns that
+# have. the digests of the new values are passed on to BatchWriter,
+# which records them once the statement is committed. updates also
+# carry the (sql, params) of an insert of the whole resource, which
+# BatchWriter runs instead if the row turns out not to be there.
+
+def generate_insert(object):
+    plan = get_plan(object)
+    plan.get_pkey_field() # fail before a pkey is handed out
+    pkey = pkeyman.generate_pkey(object)
+    values = plan.translate(object, pkey)
+    digests = None
+    if content_hashes:
+        digests = make_digests(values, plan.get_pkey_field())
+    fields = tuple([field for (field, value) in values])
+    return (plan.get_sql(insert_sql, fields),
+            [value for (field, value) in values], digests)
+
+def generate_update(object, pkey):
+    plan = get_plan(object)
+    values = plan.translate(object, pkey, False)
+    everything = values
+    digests = None
+    if content_hashes:
+        (values, digests) = find_changed(object[ID_FIELD], values, None)
+        if not values:
+            return None
+    fields = tuple([field for (field, value) in values])
+    return (plan.get_sql(update_sql, fields),
+            [value for (field, value) in values] + [pkey], digests,
+            make_insert(plan, everything, pkey))
+
+def make_insert(plan, values, pkey):
+    "Returns (sql, params) inserting the values with the given pkey."
+    values = values + [(plan.get_pkey_field(), int(pkey))]
+    values.sort()
+    fields = tuple([field for (field, value) in values])
+    return (plan.get_sql(insert_sql, fields),
+            [value for (field, value) in values])
+
+# in upsert mode the table is keyed on NATURAL_KEY_FIELD, which holds
+# the resource URI, and the database decides whether the row is new.
+# the primary key column is left to the database.
+
+def generate_upsert(object):
+    plan = get_plan(object)
+    values = plan.translate(object, include_id = False)
+    values.append((NATURAL_KEY_FIELD, object[ID_FIELD]))
+    values.sort()
+    digests = None
+    if content_hashes:
+        (changed, digests) = find_changed(object[ID_FIELD], values,
+                                          NATURAL_KEY_FIELD)
+        if not changed:
+            return None
+    fields = tuple([field for (field, value) in values])
+    return (plan.get_sql(upsert_sql, fields),
+            [value for (field, value) in values], digests)
+
+def find_changed(id, values, key_field):
+    """Returns (changed, digests): the (column, value) pairs whose values
+    differ from the ones last written for the resource, or all of them
+    if it isn't known, and the digests of all the values. key_field is
+    left out of both."""
+    values = [v for v in values if v[0] != key_field]
+    digests = make_digests(values, key_field)
+    old = content_hashes.get(id)
+    if old is None:
+        return (values, digests)
+    if old == digests:
+        return ([], digests)
+    old = dict(old)
+    return ([(field, value) for ((field, value), (f, digest))
+             in zip(values, digests) if old.get(field) != digest], digests)
+
+def make_digests(values, key_field):
+    "Returns a tuple of (column, digest) pairs, leaving out key_field."
+    return tuple([(field, hashlib.md5(unicode(value).encode("utf-8"))
+                          .digest()[ : DIGEST_SIZE])
+                  for (field, value) in values if field != key_field])
+
+# the *_sql functions make the SQL for a table and a tuple of columns.
+# MappingPlan caches the results.
+
+def insert_sql(table, fields, pkey_field):
+    return ("insert into %s (%s) values (%s)" %
+            (table, commalist(fields), commalist(["?"] * len(fields))))
+
+def update_sql(table, fields, pkey_field):
+    return ("update %s set %s where %s = ?" %
+            (table, commalist(["%s = ?" % f for f in fields]), pkey_field))
+
+def upsert_sql(table, fields, pkey_field):
+    key = NATURAL_KEY_FIELD
+    others = [field for field in fields if field != key]
+
+    if UPSERT_DIALECT in ("sqlite", "postgresql"):
+        if others:
+            action = "do update set %s" % \
+                     commalist(["%s = excluded.%s" % (f, f) for f in others])
+        else:
+            action = "do nothing"
+        return ("insert into %s (%s) values (%s) on conflict (%s) %s" %
+                (table, commalist(fields), commalist(["?"] * len(fields)),
+                 key, action))
+
+    elif UPSERT_DIALECT == "mysql":
+        updates = commalist(["%s = values(%s)" % (f, f)
+                             for f in (others or [key])])
+        return ("insert into %s (%s) values (%s) on duplicate key update %s" %
+                (table, commalist(fields), commalist(["?"] * len(fields)),
+                 updates))
+
+    elif UPSERT_DIALECT == "oracle":
+        matched = ""
+        if others:
+            matched = " when matched then update set %s" % \
+                      commalist(["t.%s = s.%s" % (f, f) for f in others])
+        return ("merge into %s t using (select %s from dual) s "
+                "on (t.%s = s.%s)%s "
+                "when not matched then insert (%s) values (%s)" %
+                (table, commalist(["? as %s" % f for f in fields]), key, key,
+                 matched, commalist(fields),
+                 commalist(["s.%s" % f for f in fields])))
+
+    raise ValueError("Unknown UPSERT_DIALECT %r" % UPSERT_DIALECT)
+
+def statement_kind(sql):
+    "Returns 'insert', 'update' or 'upsert' for SQL made by generate_sql."
+    if sql.startswith("merge ") or " on conflict " in sql or \
+       " on duplicate key " in sql:
+        return "upsert"
+    return sql.split(" ", 1)[0]
+
+def find_table_name(object):
+    return to_name(object[TYPE_FIELD])
+
+def to_name(uri):
+    pos = uri.rfind('/')
+    return uri[pos + 1 : ]
+
+#def find_pkey_field(object):
+#    return object[PKEY_FIELD]
+def find_pkey_field(object):
+    type = object[TYPE_FIELD]
+    return pkey_fields[type]
+
+def make_field_values(object, id = None, include_id = True):
+    "Returns the sorted (column, value) pairs for the object."
+    return get_plan(object).translate(object, id, include_id)
+
+def commalist(list):
+    return ", ".join(list)
+
+def remap(v, fromv, tov):
+    if v == fromv:
+        return tov
+    else:
+        return v
+
+# ---------------------------------------------------------------------------
+# the configuration is compiled into one plan per RDF type the first
+# time a resource of that type is seen
+
+plans = {} # type URI -> MappingPlan
+PLAN_SQL_CACHE_SIZE = 1000 # SQL strings kept per plan
+
+def get_plan(object):
+    type = object[TYPE_FIELD]
+    plan = plans.get(type)
+    if plan is None:
+        plan = MappingPlan(type)
+        plans[type] = plan
+    return plan
+
+FORMAT_KEY_RE = re.compile(r"%\(([^)]*)\)")
+
+class MappingPlan:
+    """The configuration applied to one RDF type: the table, the column
+    each property goes into, the compound columns, and the SQL for each
+    set of columns, so that translating a resource is a single pass
+    over its properties."""
+
+    def __init__(self, type):
+        self._table = to_name(type)
+        self._pkey_field = pkey_fields.get(type)
+        self._sql = {} # (function, columns, dialect) -> SQL
+
+        # skipped columns are dropped straight away, unless a compound
+        # column is made from them. skipped compound columns are made,
+        # and then dropped, like the rest
+        self._compound = [(column, pattern, FORMAT_KEY_RE.findall(pattern))
+                          for (column, pattern) in compound_fields]
+        used = set()
+        for (column, pattern, keys) in self._compound:
+            used.update(keys)
+            used.add(column)
+        self._skip_later = [column for column in skip_fields if column in used]
+        self._skip_now = set([column for column in skip_fields
+                              if column not in used])
+
+        # property URI -> column, or None to leave the property out
+        self._columns = {TYPE_FIELD : None, ID_FIELD : None, PKEY_FIELD : None}
+
+    def get_pkey_field(self):
+        if self._pkey_field is None:
+            raise KeyError("No primary key configured for table %s" %
+                           self._table)
+        return self._pkey_field
+
+    def translate(self, object, id = None, include_id = True):
+        "Returns the sorted (column, value) pairs for the object."
+        columns = self._columns
+        values = {}
+        for (prop, value) in object.iteritems():
+            try:
+                column = columns[prop]
+            except KeyError:
+                column = self._compile(prop)
+            if column is not None:
+                values[column] = value
+
+        if include_id:
+            values[self.get_pkey_field()] = id
+        for (column, pattern, keys) in self._compound:
+            value = (pattern % dict([(key, values.get(key, "").strip())
+                                     for key in keys])).strip()
+            if value:
+                values[column] = value
+        for column in self._skip_later:
+            values.pop(column, None)
+
+        items = values.items()
+        items.sort()
+        return items
+
+    def get_sql(self, function, fields):
+        """Returns function(table, fields, pkey field), computing it only
+        the first time."""
+        key = (function, fields, UPSERT_DIALECT)
+        sql = self._sql.get(key)
+        if sql is None:
+            if len(self._sql) >= PLAN_SQL_CACHE_SIZE: # with delta updates
+                self._sql.clear()
+            sql = function(self._table, fields, self._pkey_field)
+            self._sql[key] = sql
+        return sql
+
+    def _compile(self, prop):
+        column = to_name(prop)
+        if column in self._skip_now:
+            column = None
+        self._columns[prop] = column
+        return column
+
+# ---------------------------------------------------------------------------
+
+PKEY_LOG = "id-to-pkey.log"
+PKEY_BLOCK_SIZE = 1000
+
+class PrimaryKeyManager:
+    """Keeps the whole id-to-pkey map in memory, and appends each new
+    mapping to a log file that is replayed on startup. Keys are
+    reserved PKEY_BLOCK_SIZE at a time, and the reservation is synced
+    to disk before any of them are handed out, so that keys are never
+    reused after a crash (although some may be skipped). A mapping is
+    only logged once BatchWriter has committed the insert, so that
+    after a crash an id whose insert was lost is inserted again.
+
+    The log has one tab-separated record per line: 'R <last reserved
+    key>', 'M <id> <pkey>', or 'F <id>' for a mapping that was rolled
+    back (only in logs from older versions), in UTF-8. Ids are kept as
+    unicode."""
+
+    def __init__(self, filename = PKEY_LOG, block_size = PKEY_BLOCK_SIZE):
+        self._id_to_pkey = {}
+        self._previd = 0
+        self._reserved = 0
+        self._block_size = block_size
+        self._lock = threading.Lock()
+        self._recover(filename)
+        self._log = open(filename, 'ab')
+
+    def find_pkey_for(self, id):
+        return self._id_to_pkey.get(to_unicode(id))
+
+    def generate_pkey(self, object):
+        id = to_unicode(object[ID_FIELD])
+        self._lock.acquire()
+        try:
+            if self._previd >= self._reserved:
+                self._reserved = self._previd + self._block_size
+                self._log.write("R\t%s\n" % self._reserved)
+                self._sync()
+
+            self._previd += 1
+            pkey = self._previd
+            self._id_to_pkey[id] = str(pkey)
+            return pkey
+        finally:
+            self._lock.release()
+
+    def forget(self, ids):
+        """Drops the mappings for ids whose inserts were rolled back, so
+        that the next write of each is an insert again."""
+        self._lock.acquire()
+        try:
+            for id in ids:
+                self._id_to_pkey.pop(to_unicode(id), None)
+        finally:
+            self._lock.release()
+
+    def commit(self, ids = ()):
+        "Logs the mappings for ids whose inserts are committed, and syncs."
+        self._lock.acquire()
+        try:
+            for id in ids:
+                id = to_unicode(id)
+                pkey = self._id_to_pkey.get(id)
+                if pkey is not None:
+                    self._log.write("M\t%s\t%s\n" % (id.encode("utf-8"), pkey))
+            self._sync()
+        finally:
+            self._lock.release()
+    
+    def close(self):
+        self.commit()
+        self._log.close()
+
+    def _sync(self):
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    def _recover(self, filename):
+        if not os.path.exists(filename):
+            return
+
+        inf = open(filename, 'rb')
+        good = 0 # bytes of complete records
+        for line in inf:
+            if not line.endswith("\n"):
+                break # cut off by a crash
+            fields = line[ : -1].split("\t")
+            if fields[0] == "R":
+                self._reserved = max(self._reserved, int(fields[1]))
+            elif fields[0] == "F":
+                self._id_to_pkey.pop(fields[1].decode("utf-8"), None)
+            else:
+                self._id_to_pkey[fields[1].decode("utf-8")] = fields[2]
+            good += len(line)
+        inf.close()
+
+        if good < os.path.getsize(filename):
+            outf = open(filename, 'r+b')
+            outf.truncate(good)
+            outf.close()
+
+        # skip whatever was left of the last block
+        self._previd = self._reserved
+
+def to_unicode(id):
+    if isinstance(id, str):
+        return id.decode("utf-8")
+    return id
+
+# ---------------------------------------------------------------------------
+
+HASH_LOG = "content-hashes.log"
+DIGEST_SIZE = 8 # bytes of the MD5 of each value kept
+DELTA_UPDATES = True # skip unchanged resources, update changed columns only
+
+class ContentHashes:
+    """Remembers digests of the column values last written for each
+    resource. BatchWriter stages the digests of each statement it is
+    given, and they replace the committed ones, and are logged, when
+    the statement is committed. If it is rolled back they are dropped.
+    Staged digests take precedence when comparing, so that a resource
+    that changes twice before a commit is compared to the latest
+    version. The log is replayed on startup, and rewritten then if most
+    of it is out of date.
+
+    The log has one tab-separated record per line: '<id> <columns>
+    <digests>', with the columns separated by commas and the digests
+    in hex."""
+
+    def __init__(self, filename = HASH_LOG):
+        self._entries = {} # id -> ((column, digest), ...), as committed
+        self._staged = {} # id -> digests of uncommitted statements
+        self._lock = threading.Lock()
+        records = self._recover(filename)
+        if records > 2 * len(self._entries) + 1000:
+            self._rewrite(filename)
+        self._log = open(filename, 'ab')
+
+    def get(self, id):
+        id = to_unicode(id)
+        digests = self._staged.get(id)
+        if digests is None:
+            digests = self._entries.get(id)
+        return digests
+
+    def stage(self, id, digests):
+        self._staged[to_unicode(id)] = digests
+
+    def forget(self, ids):
+        "Drops the staged digests, after a rollback."
+        for id in ids:
+            self._staged.pop(to_unicode(id), None)
+
+    def commit(self, ids):
+        "Makes the staged digests current, logs them and syncs the log."
+        self._lock.acquire()
+        try:
+            for id in ids:
+                id = to_unicode(id)
+                digests = self._staged.pop(id, None)
+                if digests is not None:
+                    self._entries[id] = digests
+                    self._log.write(format_digests(id, digests))
+            self._log.flush()
+            os.fsync(self._log.fileno())
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._log.close()
+
+    def _recover(self, filename):
+        "Replays the log, returning the number of records in it."
+        if not os.path.exists(filename):
+            return 0
+
+        inf = open(filename, 'rb')
+        good = 0 # bytes of complete records
+        records = 0
+        for line in inf:
+            if not line.endswith("\n"):
+                break # cut off by a crash
+            (id, columns, digests) = line[ : -1].decode("utf-8").split("\t")
+            digests = str(digests).decode("hex")
+            self._entries[id] = tuple(zip(columns.split(","),
+                [digests[ix : ix + DIGEST_SIZE]
+                 for ix in range(0, len(digests), DIGEST_SIZE)]))
+            good += len(line)
+            records += 1
+        inf.close()
+
+        if good < os.path.getsize(filename):
+            outf = open(filename, 'r+b')
+            outf.truncate(good)
+            outf.close()
+        return records
+
+    def _rewrite(self, filename):
+        outf = open(filename + ".tmp", 'wb')
+        for (id, digests) in self._entries.iteritems():
+            outf.write(format_digests(id, digests))
+        outf.flush()
+        os.fsync(outf.fileno())
+        outf.close()
+        os.rename(filename + ".tmp", filename)
+
+def format_digests(id, digests):
+    return "%s\t%s\t%s\n" % (id.encode("utf-8"),
+                              ",".join([column for (column, d) in digests]),
+                              "".join([d for (c, d) in digests]).encode("hex"))
+
+# ---------------------------------------------------------------------------
+
+class DictMapper:
+
+    def __init__(self):
+        self._dict = {}
+
+    def statement(self, subj, prop, obj, lit):
+        self._dict[ID_FIELD] = subj
+        self._dict[prop] = obj
+
+    def get_dict(self):
+        return self._dict
+
+class SubjectGrouper:
+    """Groups statements by subject, passing each resource on to the
+    callback as a dict like the ones DictMapper makes. The statements
+    for each subject must come together, as they do in N-Triples from
+    SDshare servers. Call flush() after parsing to get the last one."""
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._dict = None
+
+    def statement(self, subj, prop, obj, lit):
+        if self._dict is None or self._dict[ID_FIELD] != subj:
+            self.flush()
+            self._dict = {ID_FIELD : subj}
+        self._dict[prop] = obj
+
+    def flush(self):
+        if self._dict is not None:
+            self._callback(self._dict)
+            self._dict = None
+
+def parse_data(rdf_string):
+    mapper = DictMapper()
+    # web.input() gives unicode, which splitlines() would also split on
+    # characters like U+2028 that may appear inside literals
+    parse_ntriples(rdf_string.split("\n"), mapper)
+    return mapper.get_dict()
+
+# a pure-Python N-Triples parser, so that parsing doesn't have to cross
+# into Java. datatypes and language tags are accepted, but dropped.
+# whitespace between terms is optional, and a comment may follow the
+# final dot. blank node labels may contain dots, but not end with one.
+
+BNODE_PATTERN = r'(_:[^ \t<>"#.]+(?:\.+[^ \t<>"#.]+)*)'
+TRIPLE_RE = re.compile(r'[ \t]*(?:<([^>]*)>|' + BNODE_PATTERN + r')[ \t]*'
+                       r'<([^>]*)>[ \t]*'
+                       r'(?:<([^>]*)>|' + BNODE_PATTERN + r'|'
+                       r'"([^"\\]*(?:\\.[^"\\]*)*)"'
+                       r'(?:@[-a-zA-Z0-9]+|\^\^<[^>]*>)?)'
+                       r'[ \t]*\.[ \t]*(?:#[^\r\n]*)?\r?\n?$')
+NT_ESCAPE_RE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+NT_ESCAPES = {"t" : u"\t", "n" : u"\n", "r" : u"\r", '"' : u'"',
+              "'" : u"'", "\\" : u"\\", "b" : u"\b", "f" : u"\f"}
+
+class NTriplesError(ValueError):
+    pass
+
+def parse_ntriples(lines, handler):
+    """Parses N-Triples from any iterable of lines, such as a file,
+    passing each triple to handler.statement(subject, property, object,
+    literal) as it is read. Lines may be UTF-8 bytes or unicode."""
+    match = TRIPLE_RE.match
+    lineno = 0
+    for line in lines:
+        lineno += 1
+        m = match(line)
+        if m is None:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                continue
+            raise NTriplesError("Syntax error on line %s: %r" % (lineno, line))
+
+        (subj, bsubj, prop, obj, bobj, lit) = m.groups()
+        subj = decode_term(subj or bsubj)
+        prop = decode_term(prop)
+        if lit is None:
+            handler.statement(subj, prop, decode_term(obj or bobj), False)
+        else:
+            handler.statement(subj, prop, decode_term(lit), True)
+
+def decode_term(value):
+    "Turns the text of a term into unicode, resolving escapes."
+    if isinstance(value, str):
+        value = value.decode("utf-8")
+    if "\\" in value:
+        value = NT_ESCAPE_RE.sub(unescape, value)
+    return value
+
+def unescape(match):
+    (short, long, char) = match.groups()
+    if char is not None:
+        if char not in NT_ESCAPES:
+            raise NTriplesError("Unknown escape \\%s" % char)
+        return NT_ESCAPES[char]
+    return ("\\U%08x" % int(short or long, 16)).decode("unicode-escape")
+
+# ---------------------------------------------------------------------------
+
+DRIVERCLASS = "oracle.jdbc.driver.OracleDriver"
+JDBCURL = "jdbc:oracle:thin:@d26dbbl002.test.local:1521:mod01"
+USER = "mod"
+PASSWORD = "xlesDGn3"
+
+# None to decide between insert and update with the PrimaryKeyManager,
+# or sqlite, postgresql, mysql or oracle to write native upserts keyed
+# on NATURAL_KEY_FIELD, which needs a unique constraint
+UPSERT_DIALECT = None
+NATURAL_KEY_FIELD = "sdshare_id" # column holding the resource URI
+
+BATCH_SIZE = 1000 # commit when this many statements are waiting
+COMMIT_INTERVAL = 1.0 # or when the oldest has waited this many seconds
+MAX_STATEMENTS = 100 # prepared statements kept open between commits
+
+def connect(url = JDBCURL, user = USER, password = PASSWORD,
+            driverclass = DRIVERCLASS):
+    from java.lang import Class
+    from java.sql import DriverManager
+
+    if driverclass: # not needed for JDBC 4 drivers
+        Class.forName(driverclass)
+    conn = DriverManager.getConnection(url, user, password)
+    conn.setAutoCommit(False)
+    return conn
+
+class BatchWriter:
+    """Collects statements and runs them as JDBC batches, one batch per
+    distinct SQL string, using a prepared statement for each string.
+    Everything is committed once BATCH_SIZE statements are waiting, or
+    the oldest has waited COMMIT_INTERVAL seconds.
+
+    Statements for the same resource must run in order, so if a
+    resource already has a statement waiting in a different batch the
+    waiting batches are executed before the new one is added.
+
+    An update that changes no rows is replaced by its fallback insert,
+    since the row must have been lost, say by a crash between the
+    insert and its commit in another process.
+
+    Statements can be added with a done function, which is called with
+    None once the statement is committed, or with the error if it is
+    rolled back."""
+
+    def __init__(self, conn, batch_size, interval):
+        self._conn = conn
+        self._batch_size = batch_size
+        self._interval = interval
+        self._statements = {} # sql -> PreparedStatement
+        self._batches = [] # sql strings with waiting statements, in order
+        self._waiting = {} # id -> sql of its waiting statement
+        self._staged = set() # ids with digests waiting for the commit
+        self._inserted = set() # ids given new pkeys since the last commit
+        self._reinserted = set() # ids whose updates became inserts
+        self._fallbacks = {} # update sql -> [(id, fallback)], batch order
+        self._listeners = [] # done functions of the waiting statements
+        self._count = 0
+        self._first = None # time the oldest waiting statement was added
+        self._lock = threading.Lock()
+
+    def add(self, id, sql, params, digests = None, fallback = None,
+            done = None):
+        self._lock.acquire()
+        try:
+            if self._waiting.get(id, sql) != sql:
+                self._run(self._execute)
+
+            self._add_batch(sql, params)
+            metrics.inc("sdshare_writer_statements_total",
+                        kind = statement_kind(sql))
+
+            if sql not in self._batches:
+                self._batches.append(sql)
+            self._waiting[id] = sql
+            if fallback is not None:
+                self._fallbacks.setdefault(sql, []).append((id, fallback))
+            if done is not None:
+                self._listeners.append(done)
+            if digests is not None:
+                content_hashes.stage(id, digests)
+                self._staged.add(id)
+            if sql.startswith("insert ") and not UPSERT_DIALECT:
+                self._inserted.add(id)
+            self._count += 1
+            if self._first is None:
+                self._first = time.time()
+
+            if self._count >= self._batch_size:
+                self._run(self._commit)
+        finally:
+            self._lock.release()
+
+    def commit_if_due(self):
+        self._lock.acquire()
+        try:
+            if (self._first is not None and
+                time.time() - self._first >= self._interval):
+                self._run(self._commit)
+        finally:
+            self._lock.release()
+
+    def commit(self):
+        self._lock.acquire()
+        try:
+            self._run(self._commit)
+        finally:
+            self._lock.release()
+
+    def execute(self):
+        "Runs the waiting statements without committing them."
+        self._lock.acquire()
+        try:
+            self._run(self._execute)
+        finally:
+            self._lock.release()
+
+    def check(self):
+        "Commits an empty transaction, raising if the database doesn't work."
+        self._lock.acquire()
+        try:
+            self._conn.commit()
+        finally:
+            self._lock.release()
+
+    def rollback(self):
+        "Throws away the waiting statements and rolls back."
+        self._lock.acquire()
+        try:
+            self._rollback()
+        finally:
+            self._lock.release()
+
+    def _run(self, method):
+        """Calls _execute or _commit, rolling back if it fails, since the
+        waiting statements can't be trusted after that."""
+        try:
+            method()
+        except Exception, e:
+            log.error("rolling back statements=%s", self._count)
+            self._rollback(e)
+            raise
+
+    def _rollback(self, error = "rolled back"):
+        listeners = self._listeners
+        self._listeners = []
+        batches = self._batches
+        self._batches = []
+        self._waiting = {}
+        self._fallbacks = {}
+        self._reinserted = set()
+        self._count = 0
+        self._first = None
+        if content_hashes:
+            content_hashes.forget(self._staged)
+        self._staged = set()
+        pkeyman.forget(self._inserted)
+        self._inserted = set()
+
+        try:
+            for sql in batches:
+                self._statements[sql].clearBatch()
+            self._conn.rollback()
+        except Exception:
+            log.exception("rollback failed")
+        for done in listeners:
+            done(error)
+
+    def _add_batch(self, sql, params):
+        stmt = self._statements.get(sql)
+        if not stmt:
+            stmt = self._conn.prepareStatement(sql)
+            self._statements[sql] = stmt
+        for ix in range(len(params)):
+            stmt.setObject(ix + 1, params[ix])
+        stmt.addBatch()
+
+    def _execute(self):
+        missing = {} # id -> fallback, for updates that changed no rows
+        for sql in self._batches:
+            counts = self._statements[sql].executeBatch()
+            fallbacks = self._fallbacks.get(sql, [])
+            for ix in range(len(fallbacks)):
+                if counts[ix] == 0: # not SUCCESS_NO_INFO, which is -2
+                    (id, fallback) = fallbacks[ix]
+                    missing[id] = fallback
+        self._batches = []
+        self._waiting = {}
+        self._fallbacks = {}
+
+        batches = []
+        for (id, (sql, params)) in missing.items():
+            log.warning("no row to update, inserting id=%s", id)
+            metrics.inc("sdshare_writer_reinserted_total")
+            self._add_batch(sql, params)
+            if sql not in batches:
+                batches.append(sql)
+            self._reinserted.add(id)
+        for sql in batches:
+            self._statements[sql].executeBatch()
+
+    def _commit(self):
+        if not self._count:
+            return
+        start = time.time()
+        self._execute()
+        self._conn.commit()
+        pkeyman.commit(self._inserted | self._reinserted)
+        if content_hashes:
+            content_hashes.commit(self._staged)
+        self._staged = set()
+        self._inserted = set()
+        self._reinserted = set()
+        listeners = self._listeners
+        self._listeners = []
+        for done in listeners:
+            done(None)
+        if len(self._statements) > MAX_STATEMENTS:
+            # delta updates make many different statements
+            for stmt in self._statements.values():
+                stmt.close()
+            self._statements = {}
+        secs = time.time() - start
+        metrics.observe("sdshare_writer_commit_seconds", secs)
+        log.debug("committed statements=%s secs=%.3f", self._count, secs)
+        self._count = 0
+        self._first = None
+
+    def close(self):
+        self.commit()
+        for stmt in self._statements.values():
+            stmt.close()
+
+    def abandon(self):
+        "Rolls back and closes the connection, which may be broken."
+        self.rollback()
+        try:
+            for stmt in self._statements.values():
+                stmt.close()
+            self._conn.close()
+        except Exception:
+            log.exception("closing connection failed")
+
+writer = None # set on startup
+pkeyman = None
+content_hashes = None # set on startup if DELTA_UPDATES is
+queue = None # set on startup if QUEUE_DIR is
+
+def commit_periodically():
+    while True:
+        time.sleep(COMMIT_INTERVAL)
+        try:
+            writer.commit_if_due()
+        except Exception:
+            log.exception("periodic commit failed")
+
+# ---------------------------------------------------------------------------
+# queued writes
+
+QUEUE_DIR = None # set to a directory to reply before writing to the database
+QUEUE_WORKERS = 4 # partitions, each with a thread and a connection
+QUEUE_SIZE = 100000 # resources waiting before requests get 503
+RETRY_AFTER = 5 # seconds, for 503s and between attempts at failed commits
+MAX_ATTEMPTS = 5 # failures before writing one at a time, or giving up on one
+
+class WriteQueue:
+    """Takes resources from HTTP requests and has worker threads write
+    them to the database, each through its own connection. Resources
+    are partitioned on subject, so that the writes for each resource
+    happen in order. Each partition is an append-only log, synced
+    before the request is answered, so queued resources survive a
+    restart. After a crash some resources may be written twice, which
+    is harmless with UPSERT_DIALECT set. Don't change QUEUE_WORKERS
+    while there are resources in the queue.
+
+    A failed batch is retried, for as long as it takes if the database
+    is down. After MAX_ATTEMPTS failures in a row the resources are
+    written one at a time. A resource is moved to dead-letter.log if
+    SQL can't be made for it, or if its statement fails MAX_ATTEMPTS
+    times on its own while the database otherwise works."""
+
+    def __init__(self, dir, partitions = QUEUE_WORKERS, maxsize = QUEUE_SIZE):
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        self._dead_letters = os.path.join(dir, "dead-letter.log")
+        self._partitions = [QueuePartition(os.path.join(dir,
+                                                        "queue-%s.log" % ix))
+                            for ix in range(partitions)]
+        self._maxsize = maxsize
+        self._size = sum([p.get_size() for p in self._partitions])
+        self._lock = threading.Lock()
+
+    def put(self, objects):
+        """Adds the objects to the queue, returning False and adding
+        none of them if there isn't room for all."""
+        self._lock.acquire()
+        try:
+            if self._size and self._size + len(objects) > self._maxsize:
+                return False
+            self._size += len(objects)
+        finally:
+            self._lock.release()
+
+        parts = {}
+        for object in objects:
+            id = object[ID_FIELD].encode("utf-8")
+            ix = (zlib.crc32(id) & 0xffffffff) % len(self._partitions)
+            parts.setdefault(ix, []).append(object)
+        try:
+            for (ix, objects) in parts.items():
+                self._partitions[ix].append(objects)
+        except:
+            self._removed(sum(map(len, parts.values())))
+            raise
+        metrics.inc("sdshare_writer_queued_total",
+                    sum(map(len, parts.values())))
+        return True
+
+    def start(self, make_writer):
+        """Starts one worker thread per partition. make_writer is called
+        in each thread to make its BatchWriter."""
+        for partition in self._partitions:
+            worker = threading.Thread(target = self._drain,
+                                      args = (partition, make_writer))
+            worker.setDaemon(True)
+            worker.start()
+
+    def _drain(self, partition, make_writer):
+        batchwriter = None
+        failures = 0 # in a row
+        rejections = 0 # failures of a single resource's own statement
+        while True:
+            single = failures >= MAX_ATTEMPTS
+            batch = partition.peek(single and 1 or BATCH_SIZE)
+            rejected = [] # resources SQL couldn't be made for
+            stage = "connect"
+            try:
+                if batchwriter is None:
+                    batchwriter = make_writer()
+                stage = "execute"
+                for object in batch:
+                    try:
+                        statement = generate_sql(object)
+                    except Exception:
+                        log.exception("rejecting resource id=%s",
+                                      object[ID_FIELD])
+                        rejected.append(object)
+                        continue
+                    if statement is None:
+                        metrics.inc("sdshare_writer_unchanged_total")
+                        continue
+                    batchwriter.add(object[ID_FIELD], *statement)
+                batchwriter.execute()
+                stage = "commit"
+                batchwriter.commit()
+            except Exception:
+                log.exception("writing queued resources failed stage=%s",
+                              stage)
+                if batchwriter:
+                    # rolling back forgets new pkeys and digests, so the
+                    # retry makes the same statements again
+                    batchwriter.abandon()
+                    batchwriter = None # the connection may be broken
+                failures += 1
+                if single and stage == "execute":
+                    # only the resource's fault if the database works
+                    try:
+                        batchwriter = make_writer()
+                        batchwriter.check()
+                        rejections += 1
+                    except Exception:
+                        log.exception("database check failed")
+                        if batchwriter:
+                            batchwriter.abandon()
+                            batchwriter = None
+                if rejections < MAX_ATTEMPTS:
+                    time.sleep(RETRY_AFTER)
+                    continue
+                rejected = batch
+
+            for object in rejected:
+                self._dead_letter(object)
+            partition.remove(len(batch))
+            self._removed(len(batch))
+            failures = 0
+            rejections = 0
+
+    def _dead_letter(self, object):
+        log.error("giving up on resource id=%s, see %s", object[ID_FIELD],
+                  self._dead_letters)
+        metrics.inc("sdshare_writer_dead_letters_total")
+        self._lock.acquire()
+        try:
+            outf = open(self._dead_letters, 'ab')
+            outf.write(encode_object(object))
+            outf.flush()
+            os.fsync(outf.fileno())
+            outf.close()
+        finally:
+            self._lock.release()
+
+    def _removed(self, count):
+        self._lock.acquire()
+        try:
+            self._size -= count
+        finally:
+            self._lock.release()
+
+class QueuePartition:
+    """An append-only log of queued resources, one per line. The .pos
+    file next to it has the offset of the first resource that isn't
+    committed yet. The log is emptied whenever everything in it has
+    been committed."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._posfile = filename + ".pos"
+        self._items = collections.deque() # (offset after resource, resource)
+        self._end = 0
+        self._cond = threading.Condition()
+        self._recover()
+        self._log = open(filename, 'ab')
+
+    def get_size(self):
+        return len(self._items)
+
+    def append(self, objects):
+        "Appends the objects and syncs them to disk."
+        self._cond.acquire()
+        try:
+            for object in objects:
+                line = encode_object(object)
+                self._log.write(line)
+                self._end += len(line)
+                self._items.append((self._end, object))
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def peek(self, count):
+        "Waits for resources, then returns up to count of the oldest."
+        self._cond.acquire()
+        try:
+            while not self._items:
+                self._cond.wait()
+            return [object for (end, object)
+                    in itertools.islice(self._items, 0, count)]
+        finally:
+            self._cond.release()
+
+    def remove(self, count):
+        "Records that the count oldest resources are committed."
+        self._cond.acquire()
+        try:
+            for ix in range(count):
+                (end, object) = self._items.popleft()
+            if not self._items:
+                # truncating first means a crash in between just leaves
+                # the position past the end, which _recover handles
+                self._log.close()
+                self._log = open(self._filename, 'wb')
+                self._end = end = 0
+            self._write_pos(end)
+        finally:
+            self._cond.release()
+
+    def _write_pos(self, pos):
+        outf = open(self._posfile + ".tmp", 'wb')
+        outf.write("%s\n" % pos)
+        outf.flush()
+        os.fsync(outf.fileno())
+        outf.close()
+        os.rename(self._posfile + ".tmp", self._posfile)
+
+    def _recover(self):
+        pos = 0
+        if os.path.exists(self._posfile):
+            pos = int(open(self._posfile).read().strip() or "0")
+        if not os.path.exists(self._filename):
+            return
+        size = os.path.getsize(self._filename)
+        if pos > size: # the log was emptied, but the position not reset
+            pos = 0
+            self._write_pos(pos)
+
+        inf = open(self._filename, 'rb')
+        inf.seek(pos)
+        good = pos
+        for line in inf:
+            if not line.endswith("\n"):
+                break # cut off by a crash
+            good += len(line)
+            self._items.append((good, decode_object(line)))
+        inf.close()
+        self._end = good
+
+        if good < size:
+            outf = open(self._filename, 'r+b')
+            outf.truncate(good)
+            outf.close()
+        if self._items:
+            log.info("recovered queued resources=%s file=%s",
+                     len(self._items), self._filename)
+
+# resources are stored as tab-separated keys and values, with
+# backslash escapes for backslashes, tabs and line breaks
+
+ESCAPES = {"\\" : "\\\\", "\t" : "\\t", "\n" : "\\n", "\r" : "\\r"}
+UNESCAPES = dict([(v[1], k) for (k, v) in ESCAPES.items()])
+ESCAPE_RE = re.compile(r"[\\\t\n\r]")
+UNESCAPE_RE = re.compile(r"\\(.)")
+
+def encode_object(object):
+    fields = []
+    for (key, value) in object.items():
+        fields.append(ESCAPE_RE.sub(lambda m: ESCAPES[m.group()], key))
+        fields.append(ESCAPE_RE.sub(lambda m: ESCAPES[m.group()], value))
+    return "\t".join(fields).encode("utf-8") + "\n"
+
+def decode_object(line):
+    fields = [UNESCAPE_RE.sub(lambda m: UNESCAPES[m.group(1)], field)
+              for field in line[ : -1].decode("utf-8").split("\t")]
+    return dict(zip(fields[0 : : 2], fields[1 : : 2]))
+
+# ---------------------------------------------------------------------------
+
+PROFILING = os.environ.get("SDSHARE_PROFILING") == "true" # allow /profile
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+count_requests = request_counter("sdshare_writer")
+
+# object = {
+#     ID_FIELD : "http://ex/adr/342343",
+#     TYPE_FIELD : "http://ex/Adressebruk",
+#     PKEY_FIELD : "adressebruk_id",
+#     "http://ex/adressekode" : "STILL",
+#     "http://ex/landkode" : "NO",
+#     "http://ex/postnr" : "0440",
+#     }
+
+# sql = generate_sql(object)
+# print sql
+# write_to_db(sql)
+
+# mapper = DictMapper()
+# inf = open(sys.argv[1], 'rb')
+# parse_ntriples(inf, mapper)
+# inf.close()
+
+# sql = generate_sql(mapper.get_dict())
+# print sql
+# #write_to_db(sql)
+
+# ---------------------------------------------------------------------------
+# had to introduce some configuration, unfortunately. these are the
+# defaults, which are replaced if MAPPING_FILE exists.
+
+MAPPING_FILE = "mapping.xml"
+
+skip_fields = set(["husnr", "gatenavn", "bokstav"])
+compound_fields = [("adrlinje1", "%(gatenavn)s %(husnr)s%(bokstav)s")]
+pkey_fields = {"http://psi.garshol.priv.no/tmp/Adresse" : "adressebruk_id",
+               "http://psi.garshol.priv.no/tmp/Person" : "person_id",
+               "http://example.com/Person" : "person_id",
+               "http://example.com/Adressebruk" : "adressebruk_id"}
+
+class MappingHandler(ContentHandler):
+    """Reads a mapping file like this:
+
+      <mapping>
+        <type uri="http://example.com/Person" pkey="person_id"/>
+        <skip column="husnr"/>
+        <compound column="adrlinje1" pattern="%(gatenavn)s %(husnr)s"/>
+      </mapping>
+    """
+
+    def __init__(self):
+        ContentHandler.__init__(self)
+        self.skip_fields = set()
+        self.compound_fields = []
+        self.pkey_fields = {}
+
+    def startElement(self, name, attrs):
+        if name == "type":
+            self.pkey_fields[attrs["uri"]] = attrs["pkey"]
+        elif name == "skip":
+            self.skip_fields.add(attrs["column"])
+        elif name == "compound":
+            self.compound_fields.append((attrs["column"], attrs["pattern"]))
+
+def load_mapping(filename):
+    "Replaces the configuration with the one in the file."
+    global skip_fields, compound_fields, pkey_fields
+    handler = MappingHandler()
+    parser = make_parser()
+    parser.setContentHandler(handler)
+    parser.parse(filename)
+    skip_fields = handler.skip_fields
+    compound_fields = handler.compound_fields
+    pkey_fields = handler.pkey_fields
+    plans.clear()
+
+# ---------------------------------------------------------------------------
+
+#web.config.debug = False
+web.webapi.internalerror = web.debugerror
+app = web.application(urls, globals())
+#app.internalerror = Error
+
+if __name__ == "__main__":
+    logging.basicConfig(format = LOG_FORMAT, level = getattr(logging,
+        os.environ.get("SDSHARE_LOG_LEVEL", "info").upper()))
+
+    # the connection is made here, so that benchmark.py can import
+    # this module without a database
+    if os.path.exists(MAPPING_FILE):
+        load_mapping(MAPPING_FILE)
+    pkeyman = PrimaryKeyManager()
+    if DELTA_UPDATES:
+        content_hashes = ContentHashes()
+    if QUEUE_DIR:
+        queue = WriteQueue(QUEUE_DIR)
+        queue.start(lambda: BatchWriter(connect(), BATCH_SIZE,
+                                        COMMIT_INTERVAL))
+    else:
+        writer = BatchWriter(connect(), BATCH_SIZE, COMMIT_INTERVAL)
+        committer = threading.Thread(target = commit_periodically)
+        committer.setDaemon(True)
+        committer.start()
+
+    try:
+        app.run(count_requests)
+    finally:
+        if writer:
+            writer.close()
+        pkeyman.close()
+        if content_hashes:
+            content_hashes.close()